@@ -0,0 +1,412 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+from models.attn import FullAttention, BlockAttention, ProbAttention
+from models.model import Informer, InformerStack
+from models.embed import TemporalEmbedding, FusedTemporalEmbedding
+from data.data_loader import Dataset_Custom, batch_window_loader
+from data.store import SeriesStore
+from convert_data import convert
+from utils.timefeatures import time_features, time_features_from_frequency_str
+from utils.distributed import init_distributed, cleanup_distributed, launch, all_reduce_sum, is_main_process
+
+parser = argparse.ArgumentParser(description='[Informer] Benchmarks')
+
+parser.add_argument('--bench', type=str, default='prob_qk', help='benchmark to run, options:[prob_qk, full_attn, compile, onnx, stack, time_features, loader, columnar, temporal_embed, distributed, train_loop]')
+parser.add_argument('--batch_size', type=int, default=32, help='batch size of the benchmark input')
+parser.add_argument('--root_path', type=str, default='../MACS Final Project Solar energy output prediction', help='root path of the data file')
+parser.add_argument('--data_path', type=str, default='Solar Power Plant Data.csv', help='data file')
+parser.add_argument('--target', type=str, default='SystemProduction', help='target feature')
+parser.add_argument('--seq_len', type=int, default=96, help='input sequence length of Informer encoder')
+parser.add_argument('--label_len', type=int, default=48, help='start token length of Informer decoder')
+parser.add_argument('--pred_len', type=int, default=24, help='prediction sequence length')
+parser.add_argument('--enc_in', type=int, default=7, help='encoder input size')
+parser.add_argument('--c_out', type=int, default=1, help='output size')
+parser.add_argument('--e_layers', type=int, default=2, help='num of encoder layers')
+parser.add_argument('--s_layers', type=str, default='3,2,1', help='num of stack encoder layers')
+parser.add_argument('--d_layers', type=int, default=1, help='num of decoder layers')
+parser.add_argument('--d_ff', type=int, default=2048, help='dimension of fcn')
+parser.add_argument('--attn', type=str, default='prob', help='attention used in encoder, options:[prob, full, block]')
+parser.add_argument('--d_model', type=int, default=512, help='dimension of model')
+parser.add_argument('--n_heads', type=int, default=8, help='num of heads')
+parser.add_argument('--factor', type=int, default=5, help='probsparse attn factor')
+parser.add_argument('--lens', type=str, default='96,300,720,1440', help='sequence lengths to benchmark')
+parser.add_argument('--repeat', type=int, default=5, help='timed repetitions per case')
+parser.add_argument('--block_size', type=int, default=128, help='key block size of BlockAttention')
+parser.add_argument('--rows', type=int, default=1000000, help='length of the minutely index in the time_features benchmark')
+parser.add_argument('--num_threads', type=int, default=0, help='intra-op threads, 0 keeps the torch default')
+parser.add_argument('--date_format', type=str, default='%d.%m.%Y-%H:%M', help='date format of the csv in the columnar benchmark')
+parser.add_argument('--log_interval', type=int, default=100, help='steps between loss read-backs in the train_loop benchmark')
+parser.add_argument('--procs', type=str, default='1,2', help='process counts of the distributed benchmark')
+parser.add_argument('--seed', type=int, default=2021, help='random seed')
+
+
+def measure(fn, repeat, memory=True):
+    # returns (seconds per call, peak bytes allocated during one call)
+    fn()
+    mem = 0
+    if memory and torch.cuda.is_available():
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        fn()
+        torch.cuda.synchronize()
+        mem = torch.cuda.max_memory_allocated() - base
+    elif memory:
+        with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+            fn()
+        # running sum of allocations and frees in op order
+        mem = cur = 0
+        for e in sorted(prof.events(), key=lambda e: e.time_range.start):
+            cur += e.self_cpu_memory_usage
+            mem = max(mem, cur)
+    start = time.time()
+    for _ in range(repeat):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.time() - start) / repeat, mem
+
+
+def prob_qk_expand(Q, K, sample_k, n_top):
+    # reference sampling of ProbAttention._prob_QK through K expanded to [B, H, L_Q, L_K, E]
+    B, H, L_K, E = K.shape
+    _, _, L_Q, _ = Q.shape
+    K_expand = K.unsqueeze(-3).expand(B, H, L_Q, L_K, E)
+    index_sample = torch.randint(L_K, (L_Q, sample_k))
+    K_sample = K_expand[:, :, torch.arange(L_Q).unsqueeze(1), index_sample, :]
+    Q_K_sample = torch.matmul(Q.unsqueeze(-2), K_sample.transpose(-2, -1)).squeeze(-2)
+    M = Q_K_sample.max(-1)[0] - torch.div(Q_K_sample.sum(-1), L_K)
+    return M.topk(n_top, sorted=False)[1]
+
+
+def bench_prob_qk(args, device):
+    attn = ProbAttention(False, args.factor)
+    E = args.d_model // args.n_heads
+    print('{:>6} {:>14} {:>14} {:>12} {:>12}'.format(
+        'L_Q', 'expand MB', 'gather MB', 'expand ms', 'gather ms'))
+    # the top-u indices are compared in tests/test_attention.py
+    for L in [int(l) for l in args.lens.split(',')]:
+        Q = torch.randn(args.batch_size, args.n_heads, L, E, device=device)
+        K = torch.randn(args.batch_size, args.n_heads, L, E, device=device)
+        sample_k = min(args.factor * int(np.ceil(np.log(L))), L)
+        n_top = min(args.factor * int(np.ceil(np.log(L))), L)
+
+        t_ref, m_ref = measure(lambda: prob_qk_expand(Q, K, sample_k, n_top), args.repeat)
+        t_new, m_new = measure(lambda: attn._prob_QK(Q, K, sample_k, n_top), args.repeat)
+        print('{:>6} {:>14.1f} {:>14.1f} {:>12.2f} {:>12.2f}'.format(
+            L, m_ref/2**20, m_new/2**20, t_ref*1e3, t_new*1e3))
+
+
+def bench_full_attn(args, device):
+    E = args.d_model // args.n_heads
+    print('{:>6} {:>6} {:>12} {:>12} {:>10} {:>10}'.format(
+        'L', 'mask', 'full MB', 'block MB', 'full ms', 'block ms'))
+    for L in [int(l) for l in args.lens.split(',')]:
+        q = torch.randn(args.batch_size, L, args.n_heads, E, device=device)
+        k = torch.randn(args.batch_size, L, args.n_heads, E, device=device)
+        v = torch.randn(args.batch_size, L, args.n_heads, E, device=device)
+        for mask_flag in [False, True]:
+            full = FullAttention(mask_flag, attention_dropout=0.).eval()
+            block = BlockAttention(mask_flag, attention_dropout=0., block_size=args.block_size).eval()
+            t_full, m_full = measure(lambda: full(q, k, v, None), args.repeat)
+            t_block, m_block = measure(lambda: block(q, k, v, None), args.repeat)
+            print('{:>6} {:>6} {:>12.1f} {:>12.1f} {:>10.2f} {:>10.2f}'.format(
+                L, str(mask_flag), m_full/2**20, m_block/2**20, t_full*1e3, t_block*1e3))
+
+
+def build_informer(args, device):
+    return Informer(args.enc_in, args.enc_in, args.c_out, args.seq_len, args.label_len, args.pred_len,
+                    args.factor, args.d_model, args.n_heads, args.e_layers, args.d_layers, args.d_ff,
+                    0.0, args.attn, 'timeF', 'h', 'gelu', False, True, True, device).float().to(device).eval()
+
+
+def informer_batch(args, device):
+    dec_len = args.label_len + args.pred_len
+    return (torch.randn(args.batch_size, args.seq_len, args.enc_in, device=device),
+            torch.randn(args.batch_size, args.seq_len, 4, device=device),
+            torch.randn(args.batch_size, dec_len, args.enc_in, device=device),
+            torch.randn(args.batch_size, dec_len, 4, device=device))
+
+
+def bench_compile(args, device):
+    model = build_informer(args, device)
+    batch = informer_batch(args, device)
+    variants = [('eager', model), ('script', torch.jit.script(model))]
+    if hasattr(torch, 'compile'):
+        variants.append(('compile', torch.compile(model)))
+
+    # outputs are compared in tests/test_model_modes.py
+    print('{:>8} {:>10}'.format('mode', 'ms/batch'))
+    for name, fn in variants:
+        t, _ = measure(lambda: fn(*batch), args.repeat)
+        print('{:>8} {:>10.2f}'.format(name, t*1e3))
+
+
+def bench_onnx(args, device):
+    import onnxruntime
+    from exp.exp_informer import export_onnx
+    from utils.onnx_runtime import OnnxPredictor
+
+    data_set = Dataset_Custom(root_path=args.root_path, data_path=args.data_path, flag='test',
+                              size=[args.seq_len, args.label_len, args.pred_len], features='MS',
+                              target=args.target, timeenc=1, freq='h')
+    data_loader = torch.utils.data.DataLoader(data_set, batch_size=args.batch_size, shuffle=False, drop_last=True)
+
+    model = build_informer(args, torch.device('cpu'))
+    for module in model.modules():
+        if isinstance(module, ProbAttention):
+            module.deterministic = True
+
+    def inputs(batch):
+        batch_x, batch_y, batch_x_mark, batch_y_mark = [b.float() for b in batch]
+        dec_inp = torch.cat([batch_y[:, :args.label_len], torch.zeros_like(batch_y[:, args.label_len:])], dim=1)
+        return batch_x, batch_x_mark, dec_inp, batch_y_mark
+
+    path = '/tmp/informer_bench.onnx'
+    export_onnx(model, path, inputs(next(iter(data_loader))))
+    predictor = OnnxPredictor(path)
+
+    # outputs are compared in tests/test_onnx.py
+    t_torch = 0.; t_ort = 0.
+    for batch in data_loader:
+        x = inputs(batch)
+        start = time.time()
+        model(*x)
+        t_torch += time.time() - start
+        start = time.time()
+        predictor(*[b.numpy() for b in x])
+        t_ort += time.time() - start
+    n = len(data_loader)
+    print('onnxruntime {} | {} test batches on {}'.format(onnxruntime.__version__, n, args.data_path))
+    print('torch {:.2f} ms/batch, onnxruntime {:.2f} ms/batch'.format(t_torch/n*1e3, t_ort/n*1e3))
+
+
+def bench_stack(args, device):
+    e_layers = [int(s_l) for s_l in args.s_layers.split(',')]
+    model = InformerStack(args.enc_in, args.enc_in, args.c_out, args.seq_len, args.label_len, args.pred_len,
+                          args.factor, args.d_model, args.n_heads, e_layers, args.d_layers, args.d_ff,
+                          0.0, args.attn, 'timeF', 'h', 'gelu', False, True, True, device).float().to(device).eval()
+    batch = informer_batch(args, device)
+
+    # outputs are compared in tests/test_model_modes.py
+    variants = [('sequential', False, model), ('threads', True, model)]
+    variants += [('script', False, torch.jit.script(model))]
+    model.encoder.concurrent = True
+    variants += [('fork', True, torch.jit.script(model))]
+
+    print('s_layers {} | {} intra-op threads, {} inter-op threads'.format(
+        e_layers, torch.get_num_threads(), torch.get_num_interop_threads()))
+    print('{:>10} {:>10}'.format('mode', 'ms/batch'))
+    for name, concurrent, fn in variants:
+        model.encoder.concurrent = concurrent
+        # the profiler does not follow forked tasks, time only
+        t, _ = measure(lambda: fn(*batch), args.repeat, memory=False)
+        print('{:>10} {:>10.2f}'.format(name, t*1e3))
+
+
+def time_features_apply(dates, timeenc, freq):
+    # reference time_features with per-row apply, on a copy of dates
+    dates = dates.copy()
+    if timeenc==1:
+        index = pd.to_datetime(dates.date.values)
+        return np.vstack([feat(index) for feat in time_features_from_frequency_str(freq)]).transpose(1,0)
+    dates['month'] = dates.date.apply(lambda row:row.month)
+    dates['day'] = dates.date.apply(lambda row:row.day)
+    dates['weekday'] = dates.date.apply(lambda row:row.weekday())
+    dates['hour'] = dates.date.apply(lambda row:row.hour)
+    dates['minute'] = dates.date.apply(lambda row:row.minute)
+    dates['minute'] = dates.minute.map(lambda x:x//15)
+    return dates[['month','day','weekday','hour','minute']].values
+
+
+def bench_time_features(args, device):
+    dates = pd.DataFrame({'date':pd.date_range('2016-07-01', periods=args.rows, freq='min')})
+    print('{} minutely rows'.format(args.rows))
+    print('{:>8} {:>12} {:>12} {:>10} {:>10}'.format(
+        'timeenc', 'apply s', 'vector s', 'apply MB', 'vector MB'))
+    # values are compared in tests/test_timefeatures.py
+    for timeenc in [0, 1]:
+        start = time.time()
+        ref = time_features_apply(dates, timeenc, 't')
+        t_ref = time.time() - start
+        start = time.time()
+        out = time_features(dates, timeenc, 't')
+        t_out = time.time() - start
+        print('{:>8} {:>12.3f} {:>12.3f} {:>10.1f} {:>10.1f}'.format(
+            timeenc, t_ref, t_out, ref.nbytes/2**20, out.nbytes/2**20))
+
+
+def bench_loader(args, device):
+    print('{:>8} {:>8} {:>14} {:>14}'.format('inverse', 'batches', 'sample ms', 'batch ms'))
+    # batches are compared in tests/test_data.py
+    for inverse in [False, True]:
+        data_set = Dataset_Custom(root_path=args.root_path, data_path=args.data_path, flag='train',
+                                  size=[args.seq_len, args.label_len, args.pred_len], features='MS',
+                                  target=args.target, inverse=inverse, timeenc=1, freq='h')
+        loaders = [torch.utils.data.DataLoader(data_set, batch_size=args.batch_size, shuffle=True, drop_last=True),
+                   batch_window_loader(data_set, args.batch_size, shuffle=True, drop_last=True)]
+        times = []
+        for loader in loaders:
+            start = time.time()
+            list(loader)
+            times.append((time.time() - start) / len(loader))
+        print('{:>8} {:>8} {:>14.3f} {:>14.3f}'.format(
+            str(inverse), len(loaders[0]), times[0]*1e3, times[1]*1e3))
+
+
+def bench_columnar(args, device):
+    data_file = os.path.join(args.root_path, args.data_path)
+    base = os.path.join('/tmp', os.path.splitext(args.data_path)[0])
+    for fmt in ['parquet', 'arrow']:
+        convert(data_file, base+'.'+fmt, fmt, args.date_format)
+    print('{:>8} {:>8} {:>10} {:>6}'.format('format', 'features', 'load s', 'same'))
+    for features in ['MS', 'S']:
+        ref = None
+        for root_path, data_path in [(args.root_path, args.data_path), ('/tmp', os.path.basename(base)+'.parquet'),
+                                     ('/tmp', os.path.basename(base)+'.arrow')]:
+            SeriesStore.clear()
+            start = time.time()
+            data_set = Dataset_Custom(root_path=root_path, data_path=data_path, flag='train',
+                                      size=[args.seq_len, args.label_len, args.pred_len], features=features,
+                                      target=args.target, timeenc=1, freq='h')
+            elapsed = time.time() - start
+            out = (data_set.data_x, data_set.data_stamp)
+            ref = ref or out
+            same = all(np.array_equal(a, b) for a, b in zip(ref, out))
+            print('{:>8} {:>8} {:>10.3f} {:>6}'.format(
+                os.path.splitext(data_path)[1][1:], features, elapsed, str(same)))
+
+
+def bench_temporal_embed(args, device):
+    print('{:>5} {:>10} {:>10} {:>10} {:>10}'.format('freq', 'fixed ms', 'fused ms', 'fixed MB', 'fused MB'))
+    # outputs are compared in tests/test_timefeatures.py
+    for freq in ['h', 't']:
+        dates = pd.DataFrame({'date':pd.date_range('2016-07-01', periods=args.batch_size*args.seq_len, freq='7min')})
+        fields = torch.from_numpy(time_features(dates, 0, freq)).reshape(args.batch_size, args.seq_len, -1).float().to(device)
+        keys = torch.from_numpy(time_features(dates, 2, freq)).reshape(args.batch_size, args.seq_len, 1).to(device)
+        fixed = TemporalEmbedding(args.d_model, 'fixed', freq).to(device)
+        fused = FusedTemporalEmbedding(args.d_model, freq).to(device)
+        t_fixed = measure(lambda: fixed(fields), args.repeat)
+        t_fused = measure(lambda: fused(keys), args.repeat)
+        print('{:>5} {:>10.3f} {:>10.3f} {:>10.1f} {:>10.1f}'.format(
+            freq, t_fixed[0]*1e3, t_fused[0]*1e3, t_fixed[1]/2**20, t_fused[1]/2**20))
+
+
+def distributed_steps(args):
+    # one rank of bench_distributed: DDP training steps on batch_size windows per rank
+    init_distributed()
+    torch.manual_seed(args.seed)
+    model = Informer(args.enc_in, args.enc_in, args.c_out, args.seq_len, args.label_len, args.pred_len,
+                     args.factor, args.d_model, args.n_heads, args.e_layers, args.d_layers, args.d_ff,
+                     0.0, args.attn, 'timeF', 'h', 'gelu', False, True, True, torch.device('cpu')).float()
+    model = torch.nn.parallel.DistributedDataParallel(model)
+    optim = torch.optim.Adam(model.parameters())
+    batch = informer_batch(args, torch.device('cpu'))
+    def step():
+        optim.zero_grad()
+        model(*batch).pow(2).mean().backward()
+        optim.step()
+    step()
+    start = time.time()
+    for _ in range(args.repeat):
+        step()
+    world_size = torch.distributed.get_world_size()
+    elapsed = all_reduce_sum([time.time() - start])[0] / world_size
+    if is_main_process():
+        print('{:>6} {:>8} {:>12.1f} {:>14.1f}'.format(world_size, torch.get_num_threads(),
+              elapsed / args.repeat * 1e3, args.batch_size * world_size * args.repeat / elapsed))
+    cleanup_distributed()
+
+
+def bench_distributed(args, device):
+    print('{} cpu cores, batch {} per rank'.format(os.cpu_count(), args.batch_size))
+    print('{:>6} {:>8} {:>12} {:>14}'.format('procs', 'threads', 'ms/step', 'samples/s'))
+    for nproc in [int(n) for n in args.procs.split(',')]:
+        launch(distributed_steps, nproc, args)
+
+
+def bench_train_loop(args, device):
+    model = Informer(args.enc_in, args.enc_in, args.c_out, args.seq_len, args.label_len, args.pred_len,
+                     args.factor, args.d_model, args.n_heads, args.e_layers, args.d_layers, args.d_ff,
+                     0.0, args.attn, 'timeF', 'h', 'gelu', False, True, True, device).float().to(device)
+    optim = torch.optim.Adam(model.parameters())
+    batch = informer_batch(args, device)
+    true = torch.randn(args.batch_size, args.pred_len, args.c_out, device=device)
+    steps = args.log_interval
+
+    def train_item():
+        # loss read back every step
+        total = []
+        for _ in range(steps):
+            optim.zero_grad()
+            loss = torch.nn.functional.mse_loss(model(*batch), true)
+            total.append(loss.item())
+            loss.backward()
+            optim.step()
+        return np.average(total)
+
+    def train_device():
+        # running sum on the device, read back once per log_interval steps
+        total = torch.zeros((), dtype=torch.float64, device=device)
+        for _ in range(steps):
+            optim.zero_grad()
+            loss = torch.nn.functional.mse_loss(model(*batch), true)
+            total += loss.detach()
+            loss.backward()
+            optim.step()
+        return total.item() / steps
+
+    def vali_grad():
+        total = []
+        for _ in range(steps):
+            # as vali did before: graph built in the forward, loss on cpu copies
+            total.append(torch.nn.functional.mse_loss(model(*batch).detach().cpu(), true.cpu()))
+        return np.average(total)
+
+    def vali_inference():
+        with torch.inference_mode():
+            total = torch.zeros((), dtype=torch.float64, device=device)
+            for _ in range(steps):
+                total += torch.nn.functional.mse_loss(model(*batch), true)
+            return total.item() / steps
+
+    print('{} steps per case'.format(steps))
+    print('{:>16} {:>12} {:>10}'.format('loop', 'samples/s', 'peak MB'))
+    with torch.enable_grad():
+        model.train()
+        for name, fn in [('train item', train_item), ('train device', train_device)]:
+            t, mem = measure(fn, args.repeat)
+            print('{:>16} {:>12.1f} {:>10.1f}'.format(name, steps*args.batch_size/t, mem/2**20))
+        model.eval()
+        for name, fn in [('vali grad', vali_grad), ('vali inference', vali_inference)]:
+            t, mem = measure(fn, args.repeat)
+            print('{:>16} {:>12.1f} {:>10.1f}'.format(name, steps*args.batch_size/t, mem/2**20))
+
+
+benches = {
+    'prob_qk':bench_prob_qk,
+    'full_attn':bench_full_attn,
+    'compile':bench_compile,
+    'onnx':bench_onnx,
+    'stack':bench_stack,
+    'time_features':bench_time_features,
+    'loader':bench_loader,
+    'columnar':bench_columnar,
+    'temporal_embed':bench_temporal_embed,
+    'distributed':bench_distributed,
+    'train_loop':bench_train_loop,
+}
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    with torch.no_grad():
+        benches[args.bench](args, device)
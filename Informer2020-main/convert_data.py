@@ -0,0 +1,47 @@
+import argparse
+import os
+
+import pandas as pd
+
+from data.data_loader import Dataset_Custom
+from data.ingest import FORMATS, parse_dates
+
+parser = argparse.ArgumentParser(description='[Informer] Convert csv data files to Parquet or Arrow')
+
+parser.add_argument('--root_path', type=str, default='../MACS Final Project Solar energy output prediction', help='root path of the data file')
+parser.add_argument('--data_path', type=str, default='Solar Power Plant Data.csv', help='csv data file')
+parser.add_argument('--format', type=str, default='parquet', help='output format, options:[parquet, arrow]')
+parser.add_argument('--out_path', type=str, default=None, help='output file, defaults to data_path with the extension of the format')
+parser.add_argument('--date_format', type=str, default=Dataset_Custom.date_format, help='strftime format of the date column, %%d.%%m.%%Y-%%H:%%M of the solar csv by default')
+parser.add_argument('--chunk_size', type=int, default=1000000, help='csv rows converted at a time')
+
+def convert(data_file, out_file, fmt, date_format=Dataset_Custom.date_format, chunk_size=1000000):
+    '''
+    writes the csv data_file to out_file with the date column as a timestamp column and the
+    other columns as float64, chunk_size rows at a time. Every chunk is parsed with the same
+    explicit date_format, an inferred one could read a chunk day-first and the next month-first.
+    '''
+    import pyarrow as pa
+    writer = None
+    for chunk in pd.read_csv(data_file, chunksize=chunk_size):
+        chunk = chunk.astype({col:'float64' for col in chunk.columns if col != 'date'})
+        chunk['date'] = parse_dates(chunk.date, date_format)
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        if writer is None:
+            if fmt == 'parquet':
+                import pyarrow.parquet as pq
+                writer = pq.ParquetWriter(out_file, table.schema)
+            else:
+                writer = pa.ipc.new_file(out_file, table.schema)
+        writer.write_table(table)
+    writer.close()
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    assert args.format in ['parquet', 'arrow'], 'unknown format {}'.format(args.format)
+    data_file = os.path.join(args.root_path, args.data_path)
+    out_file = args.out_path or os.path.splitext(data_file)[0] + '.' + args.format
+    assert FORMATS.get(os.path.splitext(out_file)[1].lower()) == args.format, \
+        '{} would not be read back as {}'.format(out_file, args.format)
+    convert(data_file, out_file, args.format, args.date_format, args.chunk_size)
+    print('{} -> {}'.format(data_file, out_file))
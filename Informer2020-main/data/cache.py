@@ -0,0 +1,68 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from functools import lru_cache
+
+# bump when the preprocessing changes, old caches are then ignored
+CACHE_VERSION = 2
+
+@lru_cache(maxsize=None)
+def _file_hash(path, size, mtime):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def file_hash(path, cache_path):
+    # content hash of path, remembered in cache_path/hashes.json while size and mtime do not change
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    index_file = os.path.join(cache_path, 'hashes.json')
+    index = {}
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            index = json.load(f)
+    if index.get(path, [None])[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return index[path][2]
+
+    index[path] = [stat.st_size, stat.st_mtime_ns, _file_hash(path, stat.st_size, stat.st_mtime_ns)]
+    tmp = '{}.tmp{}'.format(index_file, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp, index_file)
+    return index[path][2]
+
+def cached_arrays(cache_path, data_file, options, preprocess):
+    '''
+    dict of arrays returned by preprocess(out_dir), written once under cache_path keyed by the
+    content of data_file and options, then opened read-only with np.memmap. DataLoader
+    workers share the mapped pages. preprocess may write some arrays to out_dir itself as
+    name.npy, those are not saved again. An empty cache_path calls preprocess(None) every time.
+    '''
+    if not cache_path:
+        return preprocess(None)
+
+    os.makedirs(cache_path, exist_ok=True)
+    key = json.dumps({'version':CACHE_VERSION, 'file':file_hash(data_file, cache_path), 'options':options}, sort_keys=True)
+    path = os.path.join(cache_path, hashlib.sha1(key.encode()).hexdigest()[:16])
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        tmp = '{}.tmp{}'.format(path, os.getpid())
+        os.makedirs(tmp, exist_ok=True)
+        arrays = preprocess(tmp)
+        for name, array in arrays.items():
+            if not os.path.exists(os.path.join(tmp, name+'.npy')):
+                np.save(os.path.join(tmp, name+'.npy'), array)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump({'key':json.loads(key), 'data_file':data_file, 'arrays':sorted(arrays)}, f, indent=1)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # written by another process in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    with open(os.path.join(path, 'meta.json')) as f:
+        names = json.load(f)['arrays']
+    return {name:np.load(os.path.join(path, name+'.npy'), mmap_mode='r') for name in names}
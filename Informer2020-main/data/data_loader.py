@@ -1,21 +1,230 @@
 import os
+import queue
+import threading
 import numpy as np
 import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
 
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, BatchSampler, RandomSampler, SequentialSampler
 # from sklearn.preprocessing import StandardScaler
 
 from utils.tools import StandardScaler
 from utils.timefeatures import time_features
+from data.store import SeriesStore
+from data.ingest import read_columns, read_table, parse_dates, stream_file
 
 import warnings
 warnings.filterwarnings('ignore')
 
+def _cache_options(dataset):
+    # everything the preprocessed arrays depend on besides the file content
+    return {'dataset':type(dataset).__name__, 'features':dataset.features, 'target':dataset.target,
+            'scale':dataset.scale, 'timeenc':dataset.timeenc, 'freq':dataset.freq,
+            'cols':getattr(dataset, 'cols', None)}
+
+def _arrays(data, raw, scaler, **stamps):
+    # scaled float32 values, raw values for inverse, time stamps and the scaler stats
+    arrays = {'data':np.asarray(data, dtype=np.float32), 'raw':np.asarray(raw, dtype=np.float32),
+              'mean':np.asarray(scaler.mean), 'std':np.asarray(scaler.std)}
+    arrays.update(stamps)
+    return arrays
+
+def _preprocess(dataset, out_dir):
+    # scaled values, raw values, time stamps and scaler stats of the whole file, the scaler
+    # is fitted on the train split only
+    data_file = os.path.join(dataset.root_path, dataset.data_path)
+    cols_data = dataset.__data_columns__(read_columns(data_file))
+    if dataset.chunk_size:
+        # streamed into the cache for files larger than memory
+        assert out_dir is not None, 'chunked reading writes to the data cache, set cache_path'
+        return stream_file(data_file, out_dir, cols_data, dataset.__split_sizes__, dataset.scale,
+                           dataset.date_format, dataset.timeenc, dataset.freq, dataset.chunk_size)
+
+    # only the date and data columns are read
+    df_raw = read_table(data_file, ['date']+cols_data)
+    df_data = df_raw[cols_data]
+
+    scaler = StandardScaler()
+    if dataset.scale:
+        train_data = df_data[0:dataset.__split_sizes__(len(df_data))[0]]
+        scaler.fit(train_data.values)
+        data = scaler.transform(df_data.values)
+    else:
+        data = df_data.values
+
+    df_stamp = pd.DataFrame({'date':parse_dates(df_raw.date, dataset.date_format)})
+    data_stamp = time_features(df_stamp, timeenc=dataset.timeenc, freq=dataset.freq)
+
+    return _arrays(data, df_data.values, scaler, stamp=data_stamp)
+
+def _windows(array, length, start):
+    # [B, length, C] windows of array at the given starts, gathered from a strided view of all windows,
+    # the result is a transposed view of the gathered [B, C, length] block
+    return sliding_window_view(array, length, axis=0)[start].transpose(0, 2, 1)
+
+def _batch_windows(dataset, index):
+    # seq_x, seq_y, seq_x_mark, seq_y_mark for a whole batch of window starts
+    s_begin = np.asarray(index)
+    r_begin = s_begin + dataset.seq_len - dataset.label_len
+
+    seq_x = _windows(dataset.data_x, dataset.seq_len, s_begin)
+    if dataset.inverse:
+        seq_y = np.concatenate([_windows(dataset.data_x, dataset.label_len, r_begin),
+                                _windows(dataset.data_y, dataset.pred_len, r_begin+dataset.label_len)], 1)
+    else:
+        seq_y = _windows(dataset.data_y, dataset.label_len+dataset.pred_len, r_begin)
+    seq_x_mark = _windows(dataset.data_stamp, dataset.seq_len, s_begin)
+    seq_y_mark = _windows(dataset.data_stamp, dataset.label_len+dataset.pred_len, r_begin)
+
+    return seq_x, seq_y, seq_x_mark, seq_y_mark
+
+def batch_window_loader(data_set, batch_size, shuffle, drop_last, num_workers=0, sampler=None):
+    '''
+    DataLoader yielding the same batches as DataLoader(data_set, batch_size, shuffle, drop_last=drop_last),
+    but the dataset is indexed with the list of window starts of a batch and gathers them at once
+    instead of collating batch_size single windows. A given sampler replaces shuffle
+    '''
+    if sampler is None:
+        sampler = RandomSampler(data_set) if shuffle else SequentialSampler(data_set)
+    return DataLoader(data_set, batch_size=None, sampler=BatchSampler(sampler, batch_size, drop_last),
+                      num_workers=num_workers)
+
+class DeviceWindowLoader():
+    '''
+    loader over the windows of data_set with the split uploaded to device once as float32 tensors,
+    batches are gathered there by index arithmetic. Per epoch only the window starts are copied to
+    device. The batches equal those of DataLoader(data_set, batch_size, shuffle, drop_last=drop_last)
+    for the same sampler order, as float32 tensors on device. A given sampler replaces shuffle
+    '''
+    def __init__(self, data_set, batch_size, shuffle, drop_last, device, sampler=None):
+        self.data_set = data_set
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.device = device
+        if sampler is None:
+            sampler = RandomSampler(data_set) if shuffle else SequentialSampler(data_set)
+        self.sampler = sampler
+
+        upload = lambda array, dtype=np.float32: torch.from_numpy(np.array(array, dtype=dtype)).to(device)
+        self.data_x = upload(data_set.data_x)
+        self.data_y = upload(data_set.data_y) if data_set.inverse else self.data_x
+        # packed calendar keys stay int32
+        self.data_stamp = upload(data_set.data_stamp, np.int32 if data_set.timeenc==2 else np.float32)
+        self.offsets = torch.arange(max(data_set.seq_len, data_set.label_len+data_set.pred_len), device=device)
+
+    def _windows(self, array, length, start):
+        # [B, length, C] windows of array at the given starts
+        return array[start[:, None] + self.offsets[:length]]
+
+    def _batch(self, s_begin):
+        data_set = self.data_set
+        r_begin = s_begin + data_set.seq_len - data_set.label_len
+
+        seq_x = self._windows(self.data_x, data_set.seq_len, s_begin)
+        if data_set.inverse:
+            seq_y = torch.cat([self._windows(self.data_x, data_set.label_len, r_begin),
+                               self._windows(self.data_y, data_set.pred_len, r_begin+data_set.label_len)], 1)
+        else:
+            seq_y = self._windows(self.data_y, data_set.label_len+data_set.pred_len, r_begin)
+        seq_x_mark = self._windows(self.data_stamp, data_set.seq_len, s_begin)
+        seq_y_mark = self._windows(self.data_stamp, data_set.label_len+data_set.pred_len, r_begin)
+
+        return seq_x, seq_y, seq_x_mark, seq_y_mark
+
+    def __iter__(self):
+        # the only host to device copy of the epoch
+        starts = torch.tensor(list(self.sampler), device=self.device)
+        for s_begin in starts.split(self.batch_size):
+            if self.drop_last and len(s_begin) < self.batch_size:
+                break
+            yield self._batch(s_begin)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.sampler) // self.batch_size
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+class PrefetchLoader():
+    '''
+    loader whose batches are prepared ahead by a background thread: up to depth batches of
+    prepare(*batch) are copied into preallocated buffers, pinned when pin_memory is set, while
+    the caller computes. The buffers are reused, a yielded batch is valid until the next one
+    is requested; pinned buffers are only refilled once the caller's stream has read them.
+    '''
+    def __init__(self, loader, prepare, depth=2, pin_memory=False):
+        self.loader = loader
+        self.prepare = prepare
+        self.depth = depth
+        self.pin_memory = pin_memory
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _copy(self, slot, tensors):
+        # into the buffers of slot, reallocated when a batch has another shape, e.g. the last one
+        if slot is None or any(buf.shape != t.shape or buf.dtype != t.dtype for buf, t in zip(slot, tensors)):
+            slot = [torch.empty(t.shape, dtype=t.dtype, device=t.device,
+                                pin_memory=self.pin_memory and t.device.type == 'cpu') for t in tensors]
+        for buf, t in zip(slot, tensors):
+            buf.copy_(t)
+        return slot
+
+    def __iter__(self):
+        # depth slots waiting in ready, one held by the caller
+        slots = [None] * (self.depth + 1)
+        # per slot, recorded on the caller's cuda stream when it hands the slot back: its
+        # non_blocking copies out of the pinned buffers may not have run yet
+        events = [None] * len(slots)
+        record = self.pin_memory and torch.cuda.is_available()
+        free = queue.Queue(); ready = queue.Queue()
+        for i in range(len(slots)):
+            free.put(i)
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for batch in self.loader:
+                    tensors = self.prepare(*batch)
+                    i = free.get()
+                    if stop.is_set():
+                        return
+                    if events[i] is not None:
+                        events[i].synchronize()
+                    slots[i] = self._copy(slots[i], tensors)
+                    ready.put(i)
+                ready.put(None)
+            except Exception as e:
+                ready.put(e)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        held = None
+        try:
+            while True:
+                item = ready.get()
+                if held is not None:
+                    if record:
+                        events[held] = torch.cuda.current_stream().record_event()
+                    free.put(held)
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                held = item
+                yield tuple(slots[item])
+        finally:
+            # stops the producer when the caller leaves early
+            stop.set()
+            free.put(0)
+            producer.join()
+
 class Dataset_ETT_hour(Dataset):
+    date_format = "%d.%m.%Y-%H:%M"
+
     def __init__(self, root_path, flag='train', size=None, 
                  features='S', data_path='ETTh1.csv', 
-                 target='OT', scale=True, inverse=False, timeenc=0, freq='h', cols=None):
+                 target='OT', scale=True, inverse=False, timeenc=0, freq='h', cols=None, cache_path=None, chunk_size=0):
         # size [seq_len, label_len, pred_len]
         # info
         if size == None:
@@ -40,43 +249,42 @@ class Dataset_ETT_hour(Dataset):
         
         self.root_path = root_path
         self.data_path = data_path
+        self.cache_path = cache_path
+        self.chunk_size = chunk_size
         self.__read_data__()
 
-    def __read_data__(self):
-        self.scaler = StandardScaler()
-        df_raw = pd.read_csv(os.path.join(self.root_path,
-                                          self.data_path))
+    def __split_sizes__(self, num_rows):
+        return 12*30*24, 4*30*24, 4*30*24
 
-        border1s = [0, 12*30*24 - self.seq_len, 12*30*24+4*30*24 - self.seq_len]
-        border2s = [12*30*24, 12*30*24+4*30*24, 12*30*24+8*30*24]
-        border1 = border1s[self.set_type]
-        border2 = border2s[self.set_type]
-        
+    def __data_columns__(self, columns):
+        # columns: ['date', ...(features)]
         if self.features=='M' or self.features=='MS':
-            cols_data = df_raw.columns[1:]
-            df_data = df_raw[cols_data]
+            return list(columns[1:])
         elif self.features=='S':
-            df_data = df_raw[[self.target]]
+            return [self.target]
 
-        if self.scale:
-            train_data = df_data[border1s[0]:border2s[0]]
-            self.scaler.fit(train_data.values)
-            data = self.scaler.transform(df_data.values)
-        else:
-            data = df_data.values
+    def __preprocess__(self, out_dir=None):
+        return _preprocess(self, out_dir)
+
+    def __read_data__(self):
+        store = SeriesStore.open(os.path.join(self.root_path, self.data_path), _cache_options(self),
+                                 self.__preprocess__, self.cache_path)
+        self.scaler = store.scaler
 
-        df_stamp = df_raw[['date']][border1:border2]
-        df_stamp['date'] = pd.to_datetime(df_stamp.date,format="%d.%m.%Y-%H:%M")
-        data_stamp = time_features(df_stamp, timeenc=self.timeenc, freq=self.freq)
+        border1s, border2s = store.borders(self.__split_sizes__(len(store)), self.seq_len)
+        border1 = border1s[self.set_type]
+        border2 = border2s[self.set_type]
 
-        self.data_x = data[border1:border2]
+        self.data_x = store.arrays['data'][border1:border2]
         if self.inverse:
-            self.data_y = df_data.values[border1:border2]
+            self.data_y = store.arrays['raw'][border1:border2]
         else:
-            self.data_y = data[border1:border2]
-        self.data_stamp = data_stamp
+            self.data_y = store.arrays['data'][border1:border2]
+        self.data_stamp = store.arrays['stamp'][border1:border2]
     
     def __getitem__(self, index):
+        if not np.isscalar(index):
+            return _batch_windows(self, index)
         s_begin = index
         s_end = s_begin + self.seq_len
         r_begin = s_end - self.label_len 
@@ -99,9 +307,11 @@ class Dataset_ETT_hour(Dataset):
         return self.scaler.inverse_transform(data)
 
 class Dataset_ETT_minute(Dataset):
+    date_format = None
+
     def __init__(self, root_path, flag='train', size=None, 
                  features='S', data_path='ETTm1.csv', 
-                 target='OT', scale=True, inverse=False, timeenc=0, freq='t', cols=None):
+                 target='OT', scale=True, inverse=False, timeenc=0, freq='t', cols=None, cache_path=None, chunk_size=0):
         # size [seq_len, label_len, pred_len]
         # info
         if size == None:
@@ -126,43 +336,42 @@ class Dataset_ETT_minute(Dataset):
         
         self.root_path = root_path
         self.data_path = data_path
+        self.cache_path = cache_path
+        self.chunk_size = chunk_size
         self.__read_data__()
 
-    def __read_data__(self):
-        self.scaler = StandardScaler()
-        df_raw = pd.read_csv(os.path.join(self.root_path,
-                                          self.data_path))
+    def __split_sizes__(self, num_rows):
+        return 12*30*24*4, 4*30*24*4, 4*30*24*4
 
-        border1s = [0, 12*30*24*4 - self.seq_len, 12*30*24*4+4*30*24*4 - self.seq_len]
-        border2s = [12*30*24*4, 12*30*24*4+4*30*24*4, 12*30*24*4+8*30*24*4]
-        border1 = border1s[self.set_type]
-        border2 = border2s[self.set_type]
-        
+    def __data_columns__(self, columns):
+        # columns: ['date', ...(features)]
         if self.features=='M' or self.features=='MS':
-            cols_data = df_raw.columns[1:]
-            df_data = df_raw[cols_data]
+            return list(columns[1:])
         elif self.features=='S':
-            df_data = df_raw[[self.target]]
+            return [self.target]
 
-        if self.scale:
-            train_data = df_data[border1s[0]:border2s[0]]
-            self.scaler.fit(train_data.values)
-            data = self.scaler.transform(df_data.values)
-        else:
-            data = df_data.values
-            
-        df_stamp = df_raw[['date']][border1:border2]
-        df_stamp['date'] = pd.to_datetime(df_stamp.date)
-        data_stamp = time_features(df_stamp, timeenc=self.timeenc, freq=self.freq)
+    def __preprocess__(self, out_dir=None):
+        return _preprocess(self, out_dir)
+
+    def __read_data__(self):
+        store = SeriesStore.open(os.path.join(self.root_path, self.data_path), _cache_options(self),
+                                 self.__preprocess__, self.cache_path)
+        self.scaler = store.scaler
+
+        border1s, border2s = store.borders(self.__split_sizes__(len(store)), self.seq_len)
+        border1 = border1s[self.set_type]
+        border2 = border2s[self.set_type]
         
-        self.data_x = data[border1:border2]
+        self.data_x = store.arrays['data'][border1:border2]
         if self.inverse:
-            self.data_y = df_data.values[border1:border2]
+            self.data_y = store.arrays['raw'][border1:border2]
         else:
-            self.data_y = data[border1:border2]
-        self.data_stamp = data_stamp
+            self.data_y = store.arrays['data'][border1:border2]
+        self.data_stamp = store.arrays['stamp'][border1:border2]
     
     def __getitem__(self, index):
+        if not np.isscalar(index):
+            return _batch_windows(self, index)
         s_begin = index
         s_end = s_begin + self.seq_len
         r_begin = s_end - self.label_len
@@ -186,9 +395,11 @@ class Dataset_ETT_minute(Dataset):
 
 
 class Dataset_Custom(Dataset):
+    date_format = "%d.%m.%Y-%H:%M"
+
     def __init__(self, root_path, flag='train', size=None, 
                  features='S', data_path='ETTh1.csv', 
-                 target='OT', scale=True, inverse=False, timeenc=0, freq='h', cols=None):
+                 target='OT', scale=True, inverse=False, timeenc=0, freq='h', cols=None, cache_path=None, chunk_size=0):
         # size [seq_len, label_len, pred_len]
         # info
         if size == None:
@@ -213,56 +424,53 @@ class Dataset_Custom(Dataset):
         self.cols=cols
         self.root_path = root_path
         self.data_path = data_path
+        self.cache_path = cache_path
+        self.chunk_size = chunk_size
         self.__read_data__()
 
-    def __read_data__(self):
-        self.scaler = StandardScaler()
-        df_raw = pd.read_csv(os.path.join(self.root_path,
-                                          self.data_path))
+    def __split_sizes__(self, num_rows):
+        num_train = int(num_rows*0.7)
+        num_test = int(num_rows*0.2)
+        num_vali = num_rows - num_train - num_test
+        return num_train, num_vali, num_test
+
+    def __data_columns__(self, columns):
         '''
-        df_raw.columns: ['date', ...(other features), target feature]
+        columns: ['date', ...(other features), target feature]
         '''
         # cols = list(df_raw.columns); 
         if self.cols:
             cols=self.cols.copy()
             cols.remove(self.target)
         else:
-            cols = list(df_raw.columns); cols.remove(self.target); cols.remove('date')
-        df_raw = df_raw[['date']+cols+[self.target]]
-
-        num_train = int(len(df_raw)*0.7)
-        num_test = int(len(df_raw)*0.2)
-        num_vali = len(df_raw) - num_train - num_test
-        border1s = [0, num_train-self.seq_len, len(df_raw)-num_test-self.seq_len]
-        border2s = [num_train, num_train+num_vali, len(df_raw)]
-        border1 = border1s[self.set_type]
-        border2 = border2s[self.set_type]
-        
+            cols = list(columns); cols.remove(self.target); cols.remove('date')
         if self.features=='M' or self.features=='MS':
-            cols_data = df_raw.columns[1:]
-            df_data = df_raw[cols_data]
+            return cols+[self.target]
         elif self.features=='S':
-            df_data = df_raw[[self.target]]
+            return [self.target]
 
-        if self.scale:
-            train_data = df_data[border1s[0]:border2s[0]]
-            self.scaler.fit(train_data.values)
-            data = self.scaler.transform(df_data.values)
-        else:
-            data = df_data.values
-            
-        df_stamp = df_raw[['date']][border1:border2]
-        df_stamp['date'] = pd.to_datetime(df_stamp.date,format="%d.%m.%Y-%H:%M")
-        data_stamp = time_features(df_stamp, timeenc=self.timeenc, freq=self.freq)
+    def __preprocess__(self, out_dir=None):
+        return _preprocess(self, out_dir)
 
-        self.data_x = data[border1:border2]
+    def __read_data__(self):
+        store = SeriesStore.open(os.path.join(self.root_path, self.data_path), _cache_options(self),
+                                 self.__preprocess__, self.cache_path)
+        self.scaler = store.scaler
+
+        border1s, border2s = store.borders(self.__split_sizes__(len(store)), self.seq_len)
+        border1 = border1s[self.set_type]
+        border2 = border2s[self.set_type]
+
+        self.data_x = store.arrays['data'][border1:border2]
         if self.inverse:
-            self.data_y = df_data.values[border1:border2]
+            self.data_y = store.arrays['raw'][border1:border2]
         else:
-            self.data_y = data[border1:border2]
-        self.data_stamp = data_stamp
+            self.data_y = store.arrays['data'][border1:border2]
+        self.data_stamp = store.arrays['stamp'][border1:border2]
     
     def __getitem__(self, index):
+        if not np.isscalar(index):
+            return _batch_windows(self, index)
         s_begin = index
         s_end = s_begin + self.seq_len
         r_begin = s_end - self.label_len 
@@ -287,7 +495,7 @@ class Dataset_Custom(Dataset):
 class Dataset_Pred(Dataset):
     def __init__(self, root_path, flag='pred', size=None, 
                  features='S', data_path='ETTh1.csv', 
-                 target='OT', scale=True, inverse=False, timeenc=0, freq='15min', cols=None):
+                 target='OT', scale=True, inverse=False, timeenc=0, freq='15min', cols=None, cache_path=None, chunk_size=0):
         # size [seq_len, label_len, pred_len]
         # info
         if size == None:
@@ -310,38 +518,54 @@ class Dataset_Pred(Dataset):
         self.cols=cols
         self.root_path = root_path
         self.data_path = data_path
+        self.cache_path = cache_path
+        self.chunk_size = chunk_size
         self.__read_data__()
 
-    def __read_data__(self):
-        self.scaler = StandardScaler()
-        df_raw = pd.read_csv(os.path.join(self.root_path,
-                                          self.data_path))
+    def __data_columns__(self, columns):
         '''
-        df_raw.columns: ['date', ...(other features), target feature]
+        columns: ['date', ...(other features), target feature]
         '''
         if self.cols:
             cols=self.cols.copy()
             cols.remove(self.target)
         else:
-            cols = list(df_raw.columns); cols.remove(self.target); cols.remove('date')
-        df_raw = df_raw[['date']+cols+[self.target]]
-        
-        border1 = len(df_raw)-self.seq_len
-        border2 = len(df_raw)
-        
+            cols = list(columns); cols.remove(self.target); cols.remove('date')
         if self.features=='M' or self.features=='MS':
-            cols_data = df_raw.columns[1:]
-            df_data = df_raw[cols_data]
+            return cols+[self.target]
         elif self.features=='S':
-            df_data = df_raw[[self.target]]
+            return [self.target]
+
+    def __preprocess__(self, out_dir=None):
+        # fitted on every row for the last window, always read in memory
+        data_file = os.path.join(self.root_path, self.data_path)
+        cols_data = self.__data_columns__(read_columns(data_file))
+        df_raw = read_table(data_file, ['date']+cols_data)
+        df_data = df_raw[cols_data]
 
+        scaler = StandardScaler()
         if self.scale:
-            self.scaler.fit(df_data.values)
-            data = self.scaler.transform(df_data.values)
+            scaler.fit(df_data.values)
+            data = scaler.transform(df_data.values)
         else:
             data = df_data.values
+
+        # the time features depend on pred_len, they are computed for the last window only
+        if pd.api.types.is_datetime64_any_dtype(df_raw.date):
+            dates = df_raw.date.values
+        else:
+            dates = np.asarray(df_raw.date.values, dtype=str)
+        return _arrays(data, df_data.values, scaler, dates=dates)
+
+    def __read_data__(self):
+        store = SeriesStore.open(os.path.join(self.root_path, self.data_path), _cache_options(self),
+                                 self.__preprocess__, self.cache_path)
+        self.scaler = store.scaler
+
+        border1 = len(store)-self.seq_len
+        border2 = len(store)
             
-        tmp_stamp = df_raw[['date']][border1:border2]
+        tmp_stamp = pd.DataFrame({'date':store.arrays['dates'][border1:border2]})
         tmp_stamp['date'] = pd.to_datetime(tmp_stamp.date)
         pred_dates = pd.date_range(tmp_stamp.date.values[-1], periods=self.pred_len+1, freq=self.freq)
         
@@ -349,11 +573,11 @@ class Dataset_Pred(Dataset):
         df_stamp.date = list(tmp_stamp.date.values) + list(pred_dates[1:])
         data_stamp = time_features(df_stamp, timeenc=self.timeenc, freq=self.freq[-1:])
 
-        self.data_x = data[border1:border2]
+        self.data_x = store.arrays['data'][border1:border2]
         if self.inverse:
-            self.data_y = df_data.values[border1:border2]
+            self.data_y = store.arrays['raw'][border1:border2]
         else:
-            self.data_y = data[border1:border2]
+            self.data_y = store.arrays['data'][border1:border2]
         self.data_stamp = data_stamp
     
     def __getitem__(self, index):
@@ -0,0 +1,123 @@
+import os
+import numpy as np
+import pandas as pd
+from numpy.lib.format import open_memmap
+
+from utils.tools import StandardScaler
+from utils.timefeatures import time_features
+
+# columnar formats read with pyarrow, everything else is read as csv
+FORMATS = {'.parquet':'parquet', '.pq':'parquet', '.arrow':'arrow', '.feather':'arrow', '.ipc':'arrow'}
+
+def file_format(data_file):
+    return FORMATS.get(os.path.splitext(data_file)[1].lower(), 'csv')
+
+def _arrow_reader(data_file):
+    # arrow ipc file, memory mapped so batches are only read when used
+    import pyarrow as pa
+    return pa.ipc.open_file(pa.memory_map(data_file))
+
+def read_columns(data_file):
+    # column names without reading the data
+    fmt = file_format(data_file)
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.read_schema(data_file).names
+    elif fmt == 'arrow':
+        return _arrow_reader(data_file).schema.names
+    return list(pd.read_csv(data_file, nrows=0).columns)
+
+def read_table(data_file, columns=None):
+    # DataFrame of the given columns only, the other columns of columnar files are not read
+    fmt = file_format(data_file)
+    if fmt == 'parquet':
+        return pd.read_parquet(data_file, columns=columns)
+    elif fmt == 'arrow':
+        return pd.read_feather(data_file, columns=columns)
+    return pd.read_csv(data_file, usecols=columns)
+
+def read_chunks(data_file, columns, chunk_size, nrows=None):
+    # DataFrames of at most chunk_size rows of the given columns, of the first nrows rows if set
+    fmt = file_format(data_file)
+    if fmt == 'csv':
+        yield from pd.read_csv(data_file, usecols=columns, nrows=nrows, chunksize=chunk_size)
+        return
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        batches = pq.ParquetFile(data_file).iter_batches(batch_size=chunk_size, columns=columns)
+    else:
+        reader = _arrow_reader(data_file)
+        batches = (reader.get_batch(i).select(columns) for i in range(reader.num_record_batches))
+    remaining = num_rows(data_file) if nrows is None else nrows
+    for batch in batches:
+        for start in range(0, batch.num_rows, chunk_size):
+            if remaining <= 0:
+                return
+            chunk = batch.slice(start, min(chunk_size, remaining)).to_pandas()
+            remaining -= len(chunk)
+            yield chunk
+
+def parse_dates(dates, date_format=None):
+    # typed timestamp columns of parquet/arrow files are used as they are
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        return dates
+    return pd.to_datetime(dates, format=date_format)
+
+def count_rows(data_file):
+    # data rows of a csv with a header line, counted without parsing
+    lines = 0; last = b'\n'
+    with open(data_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1<<24), b''):
+            lines += chunk.count(b'\n')
+            last = chunk[-1:]
+    return lines + (last != b'\n') - 1
+
+def num_rows(data_file):
+    fmt = file_format(data_file)
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(data_file).metadata.num_rows
+    elif fmt == 'arrow':
+        reader = _arrow_reader(data_file)
+        return sum(reader.get_record_batch(i).num_rows for i in range(reader.num_record_batches))
+    return count_rows(data_file)
+
+def stream_file(data_file, out_dir, cols_data, split_sizes, scale, date_format, timeenc, freq, chunk_size):
+    '''
+    out-of-core version of the dataset preprocessing for files larger than memory, reading
+    chunk_size rows at a time:
+    1. fits the scaler on the train rows, split_sizes(num_rows)[0], with StandardScaler.partial_fit
+    2. writes scaled float32 values, raw values and time features to .npy files in out_dir
+    returns the arrays as memmaps, with the same contents as the in-memory preprocessing
+    '''
+    rows = num_rows(data_file)
+    num_train = split_sizes(rows)[0]
+    scaler = StandardScaler()
+    if scale:
+        for chunk in read_chunks(data_file, cols_data, chunk_size, nrows=num_train):
+            scaler.partial_fit(chunk[cols_data].values)
+
+    arrays = {
+        'data':open_memmap(os.path.join(out_dir, 'data.npy'), 'w+', np.float32, (rows, len(cols_data))),
+        'raw':open_memmap(os.path.join(out_dir, 'raw.npy'), 'w+', np.float32, (rows, len(cols_data))),
+    }
+    start = 0
+    for chunk in read_chunks(data_file, ['date']+cols_data, chunk_size):
+        end = start + len(chunk)
+        values = chunk[cols_data].values
+        arrays['data'][start:end] = scaler.transform(values) if scale else values
+        arrays['raw'][start:end] = values
+        df_stamp = pd.DataFrame({'date':parse_dates(chunk.date, date_format)})
+        data_stamp = time_features(df_stamp, timeenc=timeenc, freq=freq)
+        if 'stamp' not in arrays:
+            arrays['stamp'] = open_memmap(os.path.join(out_dir, 'stamp.npy'), 'w+', data_stamp.dtype,
+                                          (rows, data_stamp.shape[1]))
+        arrays['stamp'][start:end] = data_stamp
+        start = end
+    assert start == rows, '{} rows counted, {} read from {}'.format(rows, start, data_file)
+
+    for array in arrays.values():
+        array.flush()
+    arrays['mean'] = np.asarray(scaler.mean)
+    arrays['std'] = np.asarray(scaler.std)
+    return arrays
@@ -0,0 +1,46 @@
+import os
+import json
+import numpy as np
+
+from utils.tools import StandardScaler
+from data.cache import cached_arrays
+
+class SeriesStore():
+    '''
+    preprocessed arrays of one data file, loaded once per process and shared by the
+    train/val/test/pred datasets of every itr and Exp_Informer. Datasets take views of
+    their split, so the series is held once.
+    '''
+    _stores = {}
+
+    def __init__(self, arrays, scale):
+        self.arrays = arrays
+        # fitted on the train split once, shared by all splits
+        self.scaler = StandardScaler()
+        if scale:
+            self.scaler.mean = np.array(arrays['mean'])
+            self.scaler.std = np.array(arrays['std'])
+
+    @classmethod
+    def open(cls, data_file, options, preprocess, cache_path=None):
+        # options has everything preprocess() depends on besides the file content
+        stat = os.stat(data_file)
+        key = (os.path.realpath(data_file), stat.st_size, stat.st_mtime_ns,
+               json.dumps(options, sort_keys=True), cache_path or '')
+        if key not in cls._stores:
+            cls._stores[key] = cls(cached_arrays(cache_path, data_file, options, preprocess), options['scale'])
+        return cls._stores[key]
+
+    @classmethod
+    def clear(cls):
+        cls._stores.clear()
+
+    def __len__(self):
+        return len(self.arrays['data'])
+
+    def borders(self, split_sizes, seq_len):
+        # [border1, border2) of train, val and test, val and test start seq_len early for their first window
+        num_train, num_vali, num_test = split_sizes
+        border1s = [0, num_train-seq_len, num_train+num_vali-seq_len]
+        border2s = [num_train, num_train+num_vali, num_train+num_vali+num_test]
+        return border1s, border2s
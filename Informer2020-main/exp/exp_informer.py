@@ -1,8 +1,12 @@
-from data.data_loader import Dataset_ETT_hour, Dataset_ETT_minute, Dataset_Custom, Dataset_Pred
+from data.data_loader import Dataset_ETT_hour, Dataset_ETT_minute, Dataset_Custom, Dataset_Pred, DeviceWindowLoader, PrefetchLoader, batch_window_loader
 from exp.exp_basic import Exp_Basic
 from models.model import Informer, InformerStack
+from models.attn import ProbAttention, AutoAttention, calibrate_threshold
+from models.quantize import quantize_model
 
 from utils.tools import EarlyStopping, adjust_learning_rate
+from utils.distributed import ShardSampler, EpochDistributedSampler, all_reduce_sum, barrier, get_world_size, is_main_process
+from utils.checkpoint import CheckpointManager
 from utils.metrics import metric
 
 import numpy as np
@@ -11,16 +15,23 @@ import torch
 import torch.nn as nn
 from torch import optim
 from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel
 
 import os
+import copy
 import time
+import random
 
 import warnings
 warnings.filterwarnings('ignore')
 
 class Exp_Informer(Exp_Basic):
+    # auto attention thresholds measured in this process, shared by every itr
+    _thresholds = {}
+
     def __init__(self, args):
         super(Exp_Informer, self).__init__(args)
+        self.onnx_predictors = {}
     
     def _build_model(self):
         model_dict = {
@@ -52,57 +63,126 @@ class Exp_Informer(Exp_Basic):
                 self.args.mix,
                 self.device
             ).float()
+            if self.args.model=='informerstack':
+                model.encoder.concurrent = self.args.concurrent
+
+        if self.args.compile:
+            # compiled in place so state dict keys stay the same as the eager model
+            model.compile()
         
         if self.args.use_multi_gpu and self.args.use_gpu:
             model = nn.DataParallel(model, device_ids=self.args.device_ids)
+        if self.args.distributed:
+            model = DistributedDataParallel(model)
         return model
 
-    def _get_data(self, flag):
+    def _bare_model(self):
+        # the model inside DistributedDataParallel, it evaluates without collectives and its
+        # state dict has no 'module.' prefix
+        return self.model.module if isinstance(self.model, DistributedDataParallel) else self.model
+
+    def _calibrate_attention(self):
+        # length from which ProbAttention is faster than FullAttention on this device, for a fresh
+        # model only, a loaded checkpoint brings back the threshold it was trained with. Measured
+        # once per process and shape, by rank 0 for all ranks of a distributed run
+        max_len = max(self.args.seq_len, self.args.label_len+self.args.pred_len)
+        modules = [m for m in self._bare_model().modules() if isinstance(m, AutoAttention)]
+        thresholds = {}
+        for mask_flag in sorted(set(m.mask_flag for m in modules)):
+            shape = (self.args.factor, self.args.n_heads, self.args.d_model//self.args.n_heads, self.args.batch_size, max_len)
+            key = (mask_flag, shape, str(self.device))
+            if key not in Exp_Informer._thresholds:
+                threshold = calibrate_threshold(mask_flag, *shape, self.device) if is_main_process() else 0
+                Exp_Informer._thresholds[key] = int(all_reduce_sum([threshold])[0])
+            thresholds[mask_flag] = Exp_Informer._thresholds[key]
+        for module in modules:
+            module.set_threshold(thresholds[module.mask_flag])
+        print('auto attention: ProbAttention from {} keys in the encoder, {} keys in the decoder'.format(
+            thresholds.get(False), thresholds.get(True)))
+
+    def _get_data(self, flag, distributed=False):
         args = self.args
 
-        data_dict = {
-            'ETTh1':Dataset_ETT_hour,
-            'ETTh2':Dataset_ETT_hour,
-            'ETTm1':Dataset_ETT_minute,
-            'ETTm2':Dataset_ETT_minute,
-            'WTH':Dataset_Custom,
-            'ECL':Dataset_Custom,
-            'Solar':Dataset_Custom,
-            'custom':Dataset_Custom,
-        }
-        Data = data_dict[self.args.data]
-        timeenc = 0 if args.embed!='timeF' else 1
-
         if flag == 'test':
-            shuffle_flag = False; drop_last = True; batch_size = args.batch_size; freq=args.freq
+            shuffle_flag = False; drop_last = True; batch_size = args.batch_size
         elif flag=='pred':
-            shuffle_flag = False; drop_last = False; batch_size = 1; freq=args.detail_freq
-            Data = Dataset_Pred
+            shuffle_flag = False; drop_last = False; batch_size = 1
         else:
-            shuffle_flag = True; drop_last = True; batch_size = args.batch_size; freq=args.freq
-        data_set = Data(
-            root_path=args.root_path,
-            data_path=args.data_path,
-            flag=flag,
-            size=[args.seq_len, args.label_len, args.pred_len],
-            features=args.features,
-            target=args.target,
-            inverse=args.inverse,
-            timeenc=timeenc,
-            freq=freq,
-            cols=args.cols
-        )
+            shuffle_flag = True; drop_last = True; batch_size = args.batch_size
+        data_set = build_dataset(args, flag)
         print(len(data_set))
         print(flag, len(data_set))
-        data_loader = DataLoader(
-            data_set,
-            batch_size=batch_size,
-            shuffle=shuffle_flag,
-            num_workers=args.num_workers,
-            drop_last=drop_last)
+        sampler = None
+        if distributed:
+            # train windows are shuffled and split into equal steps per rank as DDP needs,
+            # val/test are split in order without padding so each window counts once
+            if flag == 'train':
+                sampler = EpochDistributedSampler(data_set, shuffle=shuffle_flag, drop_last=drop_last)
+                # its epoch is restored by --resume
+                self.train_sampler = sampler
+            else:
+                sampler = ShardSampler(data_set)
+            shuffle_flag = False
+        if args.device_data and flag != 'pred':
+            data_loader = DeviceWindowLoader(
+                data_set,
+                batch_size=batch_size,
+                shuffle=shuffle_flag,
+                drop_last=drop_last,
+                device=self.device,
+                sampler=sampler)
+        elif args.batch_windows and flag != 'pred':
+            data_loader = batch_window_loader(
+                data_set,
+                batch_size=batch_size,
+                shuffle=shuffle_flag,
+                drop_last=drop_last,
+                num_workers=args.num_workers,
+                sampler=sampler)
+        else:
+            data_loader = DataLoader(
+                data_set,
+                batch_size=batch_size,
+                shuffle=shuffle_flag,
+                sampler=sampler,
+                num_workers=args.num_workers,
+                drop_last=drop_last)
+        if args.prefetch > 0:
+            data_loader = PrefetchLoader(data_loader, self._prepare_batch, depth=args.prefetch,
+                                         pin_memory=self.device.type == 'cuda')
 
         return data_set, data_loader
 
+    def _quantized_model(self, setting, load=False):
+        # dynamic int8 copy of self.model, kept next to the float checkpoint
+        assert self.device.type == 'cpu', 'int8 dynamic quantization runs on CPU only'
+        path = os.path.join(self.args.checkpoints, setting)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        quant_model_path = path+'/'+'checkpoint_int8.pth'
+        model = quantize_model(self._bare_model())
+        if load and os.path.exists(quant_model_path):
+            model.load_state_dict(torch.load(quant_model_path))
+        else:
+            torch.save(model.state_dict(), quant_model_path)
+        return model
+
+    def _onnx_model(self, setting, data_loader, load=False):
+        # onnxruntime session on an export of self.model, created once per exported file
+        from utils.onnx_runtime import OnnxPredictor
+
+        path = os.path.join(self.args.checkpoints, setting)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        onnx_model_path = path+'/'+'model.onnx'
+        if not (load and os.path.exists(onnx_model_path)):
+            batch_x, batch_y, batch_x_mark, batch_y_mark, dec_inp = self._prepare_batch(*next(iter(data_loader))[:4])
+            export_onnx(self.model, onnx_model_path, (batch_x, batch_x_mark, dec_inp, batch_y_mark))
+            self.onnx_predictors.pop(onnx_model_path, None)
+        if onnx_model_path not in self.onnx_predictors:
+            self.onnx_predictors[onnx_model_path] = OnnxPredictor(onnx_model_path)
+        return self.onnx_predictors[onnx_model_path]
+
     def _select_optimizer(self):
         model_optim = optim.Adam(self.model.parameters(), lr=self.args.learning_rate)
         return model_optim
@@ -113,20 +193,53 @@ class Exp_Informer(Exp_Basic):
 
     def vali(self, vali_data, vali_loader, criterion):
         self.model.eval()
-        total_loss = []
-        for i, (batch_x,batch_y,batch_x_mark,batch_y_mark) in enumerate(vali_loader):
-            pred, true = self._process_one_batch(
-                vali_data, batch_x, batch_y, batch_x_mark, batch_y_mark)
-            loss = criterion(pred.detach().cpu(), true.detach().cpu())
-            total_loss.append(loss)
-        total_loss = np.average(total_loss)
+        # batch losses summed on the device and read back once, without autograd graphs
+        with torch.inference_mode():
+            total_loss = torch.zeros((), dtype=torch.float64, device=self.device)
+            for i, batch in enumerate(vali_loader):
+                pred, true = self._process_one_batch(vali_data, *batch, model=self._bare_model())
+                total_loss += criterion(pred, true)
+            # mean over the batches of all ranks
+            loss_sum, count = all_reduce_sum([total_loss.item(), len(vali_loader)])
         self.model.train()
-        return total_loss
-
-    def train(self, setting):
-        train_data, train_loader = self._get_data(flag = 'train')
-        vali_data, vali_loader = self._get_data(flag = 'val')
-        test_data, test_loader = self._get_data(flag = 'test')
+        return loss_sum / count
+
+    def _train_state(self, epoch, optimizer, early_stopping, scaler=None):
+        # everything train() needs to go on after epoch as if it had not been stopped
+        state = {
+            'epoch':epoch,
+            'model':self._bare_model().state_dict(),
+            'optimizer':optimizer.state_dict(),
+            'early_stopping':early_stopping.state_dict(),
+            'rng':{'torch':torch.get_rng_state(), 'numpy':np.random.get_state(), 'random':random.getstate()},
+        }
+        if torch.cuda.is_available():
+            state['rng']['cuda'] = torch.cuda.get_rng_state_all()
+        if scaler is not None:
+            state['scaler'] = scaler.state_dict()
+        return state
+
+    def _load_train_state(self, state, optimizer, early_stopping, scaler=None):
+        # returns the epoch to start from
+        self._bare_model().load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        early_stopping.load_state_dict(state['early_stopping'])
+        torch.set_rng_state(state['rng']['torch'].cpu())
+        np.random.set_state(state['rng']['numpy'])
+        random.setstate(state['rng']['random'])
+        if 'cuda' in state['rng'] and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all([s.cpu() for s in state['rng']['cuda']])
+        if scaler is not None and 'scaler' in state:
+            scaler.load_state_dict(state['scaler'])
+        if getattr(self, 'train_sampler', None) is not None:
+            self.train_sampler.set_epoch(state['epoch']+1)
+        return state['epoch']+1
+
+    def train(self, setting, callback=None):
+        distributed = self.args.distributed
+        train_data, train_loader = self._get_data(flag = 'train', distributed=distributed)
+        vali_data, vali_loader = self._get_data(flag = 'val', distributed=distributed)
+        test_data, test_loader = self._get_data(flag = 'test', distributed=distributed)
 
         path = os.path.join(self.args.checkpoints, setting)
         if not os.path.exists(path):
@@ -135,7 +248,9 @@ class Exp_Informer(Exp_Basic):
         time_now = time.time()
         
         train_steps = len(train_loader)
-        early_stopping = EarlyStopping(patience=self.args.patience, verbose=True)
+        # rank 0 writes for all ranks of a distributed run, they track the same all-reduced losses
+        checkpoints = CheckpointManager(path, enabled=is_main_process())
+        early_stopping = EarlyStopping(patience=self.args.patience, verbose=True, checkpoints=checkpoints)
         
         model_optim = self._select_optimizer()
         criterion =  self._select_criterion()
@@ -143,22 +258,37 @@ class Exp_Informer(Exp_Basic):
         if self.args.use_amp:
             scaler = torch.cuda.amp.GradScaler()
 
-        for epoch in range(self.args.train_epochs):
+        start_epoch = 0
+        state = None
+        if self.args.resume:
+            state = checkpoints.load('last.pth', map_location=self.device)
+            if state is not None:
+                start_epoch = self._load_train_state(state, model_optim, early_stopping,
+                                                     scaler if self.args.use_amp else None)
+                print('resuming from epoch {}'.format(start_epoch+1))
+        if state is None and self.args.attn=='auto':
+            self._calibrate_attention()
+
+        for epoch in range(start_epoch, self.args.train_epochs):
+            if early_stopping.early_stop:
+                break
             iter_count = 0
-            train_loss = []
+            # running sum on the device, read back every log_interval steps and once per epoch
+            train_loss = torch.zeros((), dtype=torch.float64, device=self.device)
             
             self.model.train()
             epoch_time = time.time()
-            for i, (batch_x,batch_y,batch_x_mark,batch_y_mark) in enumerate(train_loader):
+            step_end = time.time(); input_wait = 0
+            for i, batch in enumerate(train_loader):
+                input_wait += time.time() - step_end
                 iter_count += 1
                 
                 model_optim.zero_grad()
-                pred, true = self._process_one_batch(
-                    train_data, batch_x, batch_y, batch_x_mark, batch_y_mark)
+                pred, true = self._process_one_batch(train_data, *batch)
                 loss = criterion(pred, true)
-                train_loss.append(loss.item())
+                train_loss += loss.detach()
                 
-                if (i+1) % 100==0:
+                if (i+1) % self.args.log_interval==0:
                     print("\titers: {0}, epoch: {1} | loss: {2:.7f}".format(i + 1, epoch + 1, loss.item()))
                     speed = (time.time()-time_now)/iter_count
                     left_time = speed*((self.args.train_epochs - epoch)*train_steps - i)
@@ -173,39 +303,53 @@ class Exp_Informer(Exp_Basic):
                 else:
                     loss.backward()
                     model_optim.step()
-
-            print("Epoch: {} cost time: {}".format(epoch+1, time.time()-epoch_time))
-            train_loss = np.average(train_loss)
+                step_end = time.time()
+
+            cost_time = time.time()-epoch_time
+            print("Epoch: {} cost time: {}".format(epoch+1, cost_time))
+            print("\tthroughput: {:.1f} samples/s | input wait: {:.2f}ms/step".format(
+                train_steps*self.args.batch_size*get_world_size()/cost_time, input_wait/train_steps*1e3))
+            loss_sum, count = all_reduce_sum([train_loss.item(), train_steps])
+            train_loss = loss_sum / count
             vali_loss = self.vali(vali_data, vali_loader, criterion)
             test_loss = self.vali(test_data, test_loader, criterion)
 
             print("Epoch: {0}, Steps: {1} | Train Loss: {2:.7f} Vali Loss: {3:.7f} Test Loss: {4:.7f}".format(
                 epoch + 1, train_steps, train_loss, vali_loss, test_loss))
-            early_stopping(vali_loss, self.model, path)
+            early_stopping(vali_loss, self._bare_model(), path)
             if early_stopping.early_stop:
                 print("Early stopping")
+            else:
+                adjust_learning_rate(model_optim, epoch+1, self.args)
+            # after the lr update, so a resumed run starts from the next epoch as this one would
+            checkpoints.save(self._train_state(epoch, model_optim, early_stopping,
+                                               scaler if self.args.use_amp else None), 'last.pth')
+            # callback(epoch, vali_loss) of a sweep scheduler, returning False pauses training
+            # here, to be continued with --resume
+            if callback is not None and callback(epoch+1, vali_loss) is False:
+                print("Paused after epoch {}".format(epoch+1))
+                break
+            if early_stopping.early_stop:
                 break
-
-            adjust_learning_rate(model_optim, epoch+1, self.args)
             
         best_model_path = path+'/'+'checkpoint.pth'
-        self.model.load_state_dict(torch.load(best_model_path))
+        checkpoints.close()
+        # written by rank 0
+        barrier()
+        self._bare_model().load_state_dict(torch.load(best_model_path))
         
         return self.model
 
-    def test(self, setting):
-        test_data, test_loader = self._get_data(flag='test')
-        
-        self.model.eval()
-        
+    def _predict_split(self, model, data_set, data_loader):
         preds = []
         trues = []
         
-        for i, (batch_x,batch_y,batch_x_mark,batch_y_mark) in enumerate(test_loader):
-            pred, true = self._process_one_batch(
-                test_data, batch_x, batch_y, batch_x_mark, batch_y_mark)
-            preds.append(pred.detach().cpu().numpy())
-            trues.append(true.detach().cpu().numpy())
+        with torch.inference_mode():
+            for i, batch in enumerate(data_loader):
+                pred, true = self._process_one_batch(data_set, *batch, model=model)
+                preds.append(pred.detach().cpu().numpy())
+                # a copy, prefetch buffers are reused
+                trues.append(true.detach().cpu().numpy().copy())
 
         preds = np.array(preds)
         trues = np.array(trues)
@@ -213,6 +357,16 @@ class Exp_Informer(Exp_Basic):
         preds = preds.reshape(-1, preds.shape[-2], preds.shape[-1])
         trues = trues.reshape(-1, trues.shape[-2], trues.shape[-1])
         print('test shape:', preds.shape, trues.shape)
+        return preds, trues
+
+    def test(self, setting):
+        test_data, test_loader = self._get_data(flag='test')
+        
+        self.model.eval()
+        
+        # ProbAttention samples keys on the CPU generator, replay it for the quantized pass
+        rng_state = torch.get_rng_state()
+        preds, trues = self._predict_split(self._bare_model(), test_data, test_loader)
 
         # result save
         folder_path = './results/' + setting +'/'
@@ -222,6 +376,26 @@ class Exp_Informer(Exp_Basic):
         mae, mse, rmse, mape, mspe = metric(preds, trues)
         print('mse:{}, mae:{}'.format(mse, mae))
 
+        if self.args.backend == 'onnxruntime':
+            # the pass above sampled keys at random, runtime parity is measured against a torch
+            # pass sampling them deterministically as the exported graph does
+            d_preds, _ = self._predict_split(deterministic_model(self._bare_model()), test_data, test_loader)
+            d_mae, d_mse = metric(d_preds, trues)[:2]
+            preds, trues = self._predict_split(self._onnx_model(setting, test_loader), test_data, test_loader)
+            o_mae, o_mse, o_rmse, o_mape, o_mspe = metric(preds, trues)
+            print('onnxruntime mse:{}, mae:{} | vs deterministic torch: delta mse:{}, mae:{}, max diff:{}'.format(
+                o_mse, o_mae, o_mse-d_mse, o_mae-d_mae, np.abs(preds-d_preds).max()))
+            np.save(folder_path+'metrics_torch.npy', np.array([mae, mse, rmse, mape, mspe]))
+            mae, mse, rmse, mape, mspe = o_mae, o_mse, o_rmse, o_mape, o_mspe
+
+        if self.args.quantize == 'int8':
+            torch.set_rng_state(rng_state)
+            preds, trues = self._predict_split(self._quantized_model(setting), test_data, test_loader)
+            q_mae, q_mse, q_rmse, q_mape, q_mspe = metric(preds, trues)
+            print('int8 mse:{}, mae:{} | delta mse:{}, mae:{}'.format(q_mse, q_mae, q_mse-mse, q_mae-mae))
+            np.save(folder_path+'metrics_float.npy', np.array([mae, mse, rmse, mape, mspe]))
+            mae, mse, rmse, mape, mspe = q_mae, q_mse, q_rmse, q_mape, q_mspe
+
         np.save(folder_path+'metrics.npy', np.array([mae, mse, rmse, mape, mspe]))
         np.save(folder_path+'pred.npy', preds)
         np.save(folder_path+'true.npy', trues)
@@ -234,16 +408,22 @@ class Exp_Informer(Exp_Basic):
         if load:
             path = os.path.join(self.args.checkpoints, setting)
             best_model_path = path+'/'+'checkpoint.pth'
-            self.model.load_state_dict(torch.load(best_model_path))
+            self._bare_model().load_state_dict(torch.load(best_model_path))
 
         self.model.eval()
+        if self.args.backend == 'onnxruntime':
+            model = self._onnx_model(setting, pred_loader, load=load)
+        elif self.args.quantize == 'int8':
+            model = self._quantized_model(setting, load=load)
+        else:
+            model = self._bare_model()
         
         preds = []
         
-        for i, (batch_x,batch_y,batch_x_mark,batch_y_mark) in enumerate(pred_loader):
-            pred, true = self._process_one_batch(
-                pred_data, batch_x, batch_y, batch_x_mark, batch_y_mark)
-            preds.append(pred.detach().cpu().numpy())
+        with torch.inference_mode():
+            for i, batch in enumerate(pred_loader):
+                pred, true = self._process_one_batch(pred_data, *batch, model=model)
+                preds.append(pred.detach().cpu().numpy())
 
         preds = np.array(preds)
         preds = preds.reshape(-1, preds.shape[-2], preds.shape[-1])
@@ -257,34 +437,130 @@ class Exp_Informer(Exp_Basic):
         
         return
 
-    def _process_one_batch(self, dataset_object, batch_x, batch_y, batch_x_mark, batch_y_mark):
-        batch_x = batch_x.float().to(self.device)
-        batch_y = batch_y.float()
-
-        batch_x_mark = batch_x_mark.float().to(self.device)
-        batch_y_mark = batch_y_mark.float().to(self.device)
-
-        # decoder input
-        if self.args.padding==0:
-            dec_inp = torch.zeros([batch_y.shape[0], self.args.pred_len, batch_y.shape[-1]]).float()
-        elif self.args.padding==1:
-            dec_inp = torch.ones([batch_y.shape[0], self.args.pred_len, batch_y.shape[-1]]).float()
-        dec_inp = torch.cat([batch_y[:,:self.args.label_len,:], dec_inp], dim=1).float().to(self.device)
+    def _process_one_batch(self, dataset_object, batch_x, batch_y, batch_x_mark, batch_y_mark, dec_inp=None, model=None):
+        if model is None:
+            model = self.model
+        if dec_inp is None:
+            batch_x, batch_y, batch_x_mark, batch_y_mark, dec_inp = self._prepare_batch(
+                batch_x, batch_y, batch_x_mark, batch_y_mark)
+        batch_x = batch_x.to(self.device, non_blocking=True)
+        batch_x_mark = batch_x_mark.to(self.device, non_blocking=True)
+        batch_y_mark = batch_y_mark.to(self.device, non_blocking=True)
+        dec_inp = dec_inp.to(self.device, non_blocking=True)
         # encoder - decoder
-        if self.args.use_amp:
+        if not isinstance(model, nn.Module):
+            # onnxruntime predictor, numpy in and out
+            outputs = torch.from_numpy(model(batch_x.cpu().numpy(), batch_x_mark.cpu().numpy(),
+                                             dec_inp.cpu().numpy(), batch_y_mark.cpu().numpy())).to(self.device)
+        elif self.args.use_amp:
             with torch.cuda.amp.autocast():
                 if self.args.output_attention:
-                    outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)[0]
+                    outputs = model(batch_x, batch_x_mark, dec_inp, batch_y_mark)[0]
                 else:
-                    outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)
+                    outputs = model(batch_x, batch_x_mark, dec_inp, batch_y_mark)
+        elif self.args.precision == 'bf16' and model in (self.model, self._bare_model()):
+            # the int8 model keeps float32 activations
+            with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16):
+                if self.args.output_attention:
+                    outputs = model(batch_x, batch_x_mark, dec_inp, batch_y_mark)[0]
+                else:
+                    outputs = model(batch_x, batch_x_mark, dec_inp, batch_y_mark)
+            outputs = outputs.float()
         else:
             if self.args.output_attention:
-                outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)[0]
+                outputs = model(batch_x, batch_x_mark, dec_inp, batch_y_mark)[0]
             else:
-                outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)
+                outputs = model(batch_x, batch_x_mark, dec_inp, batch_y_mark)
         if self.args.inverse:
             outputs = dataset_object.inverse_transform(outputs)
         f_dim = -1 if self.args.features=='MS' else 0
         batch_y = batch_y[:,-self.args.pred_len:,f_dim:].to(self.device)
 
         return outputs, batch_y
+
+    def _prepare_batch(self, batch_x, batch_y, batch_x_mark, batch_y_mark):
+        # float inputs and the decoder input, on the device of the batch, run by PrefetchLoader ahead of the step
+        batch_x = batch_x.float(); batch_y = batch_y.float()
+        # packed calendar keys of the fused embedding stay int32
+        if self.args.embed != 'fused':
+            batch_x_mark = batch_x_mark.float(); batch_y_mark = batch_y_mark.float()
+        return batch_x, batch_y, batch_x_mark, batch_y_mark, self._decoder_input(batch_y)
+
+    def _decoder_input(self, batch_y):
+        # created on the device of batch_y
+        if self.args.padding==0:
+            dec_inp = torch.zeros_like(batch_y[:,-self.args.pred_len:,:]).float()
+        elif self.args.padding==1:
+            dec_inp = torch.ones_like(batch_y[:,-self.args.pred_len:,:]).float()
+        return torch.cat([batch_y[:,:self.args.label_len,:], dec_inp], dim=1).float()
+
+
+def build_dataset(args, flag):
+    data_dict = {
+        'ETTh1':Dataset_ETT_hour,
+        'ETTh2':Dataset_ETT_hour,
+        'ETTm1':Dataset_ETT_minute,
+        'ETTm2':Dataset_ETT_minute,
+        'WTH':Dataset_Custom,
+        'ECL':Dataset_Custom,
+        'Solar':Dataset_Custom,
+        'custom':Dataset_Custom,
+    }
+    Data = data_dict[args.data]
+    timeenc = {'timeF':1, 'fused':2}.get(args.embed, 0)
+    freq = args.freq
+    if flag=='pred':
+        Data = Dataset_Pred; freq = args.detail_freq
+    data_set = Data(
+        root_path=args.root_path,
+        data_path=args.data_path,
+        flag=flag,
+        size=[args.seq_len, args.label_len, args.pred_len],
+        features=args.features,
+        target=args.target,
+        inverse=args.inverse,
+        timeenc=timeenc,
+        freq=freq,
+        cols=args.cols,
+        cache_path=args.cache_path,
+        chunk_size=args.chunk_size
+    )
+    return data_set
+
+
+def prepare_data(args):
+    # fills the data cache of every split, without a model or a process group
+    for flag in ['train', 'val', 'test', 'pred']:
+        print(flag, len(build_dataset(args, flag)))
+
+
+def export_model(args, checkpoint):
+    # TorchScript module of a trained model, runs without the python model code
+    args = copy.copy(args)
+    args.compile = False; args.use_multi_gpu = False; args.distributed = False
+    exp = Exp_Informer(args)
+    exp.model.load_state_dict(torch.load(checkpoint, map_location=exp.device))
+    exp.model.eval()
+    return torch.jit.script(exp.model)
+
+
+def deterministic_model(model):
+    # eval copy of model whose ProbAttention samples keys deterministically
+    model = copy.deepcopy(model.module if isinstance(model, (nn.DataParallel, DistributedDataParallel)) else model).eval()
+    for module in model.modules():
+        if isinstance(module, ProbAttention):
+            module.deterministic = True
+    return model
+
+
+def export_onnx(model, path, sample_inputs):
+    # onnx graph of model with a dynamic batch dim, ProbAttention samples keys deterministically
+    # since the exported graph has no RNG to replay
+    model = deterministic_model(model).cpu()
+    input_names = ['x_enc', 'x_mark_enc', 'x_dec', 'x_mark_dec']
+    output_names = ['pred', 'attns'] if model.output_attention else ['pred']
+    with torch.no_grad():
+        torch.onnx.export(model, tuple(x.cpu() for x in sample_inputs), path,
+                          input_names=input_names, output_names=output_names,
+                          dynamic_axes={name:{0:'batch'} for name in input_names+['pred']},
+                          opset_version=17, dynamo=False)
@@ -1,8 +1,14 @@
 import argparse
+import json
 import os
 import torch
 
-from exp.exp_informer import Exp_Informer
+from exp.exp_informer import Exp_Informer, export_model, prepare_data
+from utils.distributed import init_distributed, cleanup_distributed, launch, barrier, is_main_process
+
+# cores of a sweep.py trial, pinned before torch starts its thread pools
+if os.environ.get('INFORMER_CORES') and hasattr(os, 'sched_setaffinity'):
+    os.sched_setaffinity(0, [int(c) for c in os.environ['INFORMER_CORES'].split(',')])
 
 parser = argparse.ArgumentParser(description='[Informer] Long Sequences Forecasting')
 
@@ -14,6 +20,9 @@ parser.add_argument('--data_path', type=str, default='Solar Power Plant Data.csv
 parser.add_argument('--features', type=str, default='MS', help='forecasting task, options:[M, S, MS]; M:multivariate predict multivariate, S:univariate predict univariate, MS:multivariate predict univariate')
 parser.add_argument('--target', type=str, default='SystemProduction', help='target feature in S or MS task')
 parser.add_argument('--freq', type=str, default='h', help='freq for time features encoding, options:[s:secondly, t:minutely, h:hourly, d:daily, b:business days, w:weekly, m:monthly], you can also use more detailed freq like 15min or 3h')
+parser.add_argument('--cache_path', type=str, default='./cache/', help='location of the preprocessed data cache, empty to read the data file every time')
+parser.add_argument('--prepare_data', action='store_true', help='only preprocess the data into cache_path and exit', default=False)
+parser.add_argument('--chunk_size', type=int, default=0, help='rows per chunk when streaming the data file into the cache, 0 reads it at once')
 parser.add_argument('--checkpoints', type=str, default='./checkpoints/', help='location of model checkpoints')
 
 parser.add_argument('--seq_len', type=int, default=300, help='input sequence length of Informer encoder')
@@ -34,29 +43,44 @@ parser.add_argument('--factor', type=int, default=5, help='probsparse attn facto
 parser.add_argument('--padding', type=int, default=0, help='padding type')
 parser.add_argument('--distil', action='store_false', help='whether to use distilling in encoder, using this argument means not using distilling', default=True)
 parser.add_argument('--dropout', type=float, default=0.05, help='dropout')
-parser.add_argument('--attn', type=str, default='prob', help='attention used in encoder, options:[prob, full]')
-parser.add_argument('--embed', type=str, default='timeF', help='time features encoding, options:[timeF, fixed, learned]')
+parser.add_argument('--attn', type=str, default='prob', help='attention used in encoder, options:[prob, full, block, auto]; block is full attention computed blockwise, also used for decoder cross attention; auto picks prob or full per layer from its sequence length')
+parser.add_argument('--embed', type=str, default='timeF', help='time features encoding, options:[timeF, fixed, learned, fused]; fused is fixed on packed calendar keys')
 parser.add_argument('--activation', type=str, default='gelu',help='activation')
 parser.add_argument('--output_attention', action='store_true', help='whether to output attention in ecoder')
 parser.add_argument('--do_predict', action='store_false', help='whether to predict unseen future data')
 parser.add_argument('--mix', action='store_false', help='use mix attention in generative decoder', default=True)
 parser.add_argument('--cols', type=str, nargs='+', help='certain cols from the data files as the input features')
 parser.add_argument('--num_workers', type=int, default=0, help='data loader num workers')
+parser.add_argument('--batch_windows', action='store_true', help='gather whole batches of windows in the dataset instead of collating single windows', default=False)
+parser.add_argument('--device_data', action='store_true', help='keep the data splits on the device and gather batches there, only window starts are copied per epoch', default=False)
+parser.add_argument('--prefetch', type=int, default=0, help='batches prepared ahead by a background thread into reused buffers, 0 disables')
 parser.add_argument('--itr', type=int, default=2, help='experiments times')
 parser.add_argument('--train_epochs', type=int, default=6, help='train epochs')
 parser.add_argument('--batch_size', type=int, default=32, help='batch size of train input data')
+parser.add_argument('--log_interval', type=int, default=100, help='train steps between loss printouts, the running loss is only read back from the device then')
 parser.add_argument('--patience', type=int, default=3, help='early stopping patience')
+parser.add_argument('--report', type=str, default=None, help='file the vali loss of every epoch is appended to as json lines, read by sweep.py')
+parser.add_argument('--stop_epoch', type=int, default=0, help='pause training after this epoch, before train_epochs, without testing; continued with --resume')
+parser.add_argument('--resume', action='store_true', help='continue training from the last.pth full training state saved after every epoch in the checkpoint folder', default=False)
 parser.add_argument('--learning_rate', type=float, default=0.0001, help='optimizer learning rate')
 parser.add_argument('--des', type=str, default='test',help='exp description')
 parser.add_argument('--loss', type=str, default='mse',help='loss function')
 parser.add_argument('--lradj', type=str, default='type1',help='adjust learning rate')
 parser.add_argument('--use_amp', action='store_true', help='use automatic mixed precision training', default=False)
+parser.add_argument('--precision', type=str, default='fp32', help='precision of the forward passes, options:[fp32, bf16]; bf16 runs them under autocast, also on CPU')
 parser.add_argument('--inverse', action='store_true', help='inverse output data', default=False)
+parser.add_argument('--compile', action='store_true', help='run the model through torch.compile', default=False)
+parser.add_argument('--quantize', type=str, default='none', help='quantized CPU inference in test and predict, options:[none, int8]')
+parser.add_argument('--backend', type=str, default='torch', help='inference backend of test and predict, options:[torch, onnxruntime]')
+parser.add_argument('--concurrent', action='store_true', help='run the sub-encoders of informerstack concurrently', default=False)
+parser.add_argument('--export', action='store_true', help='save a TorchScript model next to the checkpoint', default=False)
 
 parser.add_argument('--use_gpu', type=bool, default=True, help='use gpu')
 parser.add_argument('--gpu', type=int, default=0, help='gpu')
 parser.add_argument('--use_multi_gpu', action='store_true', help='use multiple gpus', default=False)
 parser.add_argument('--devices', type=str, default='0,1,2,3',help='device ids of multile gpus')
+parser.add_argument('--distributed', action='store_true', help='data parallel training in several CPU processes with torch.distributed (gloo), started by torchrun or locally with --nproc, batch_size is per process', default=False)
+parser.add_argument('--nproc', type=int, default=2, help='local processes of --distributed when not started by torchrun')
 
 args = parser.parse_args()
 
@@ -88,27 +112,70 @@ args.s_layers = [int(s_l) for s_l in args.s_layers.replace(' ','').split(',')]
 args.detail_freq = args.freq
 args.freq = args.freq[-1:]
 
-print('Args in experiment:')
-print(args)
-
 Exp = Exp_Informer
 
-for ii in range(args.itr):
-    # setting record of experiments
-    setting = '{}_{}_ft{}_sl{}_ll{}_pl{}_dm{}_nh{}_el{}_dl{}_df{}_at{}_fc{}_eb{}_dt{}_mx{}_{}_{}'.format(args.model, args.data, args.features, 
-                args.seq_len, args.label_len, args.pred_len,
-                args.d_model, args.n_heads, args.e_layers, args.d_layers, args.d_ff, args.attn, args.factor, 
-                args.embed, args.distil, args.mix, args.des, ii)
-
-    exp = Exp(args) # set experiments
-    print('>>>>>>>start training : {}>>>>>>>>>>>>>>>>>>>>>>>>>>'.format(setting))
-    exp.train(setting)
+def run(args):
+    if args.prepare_data:
+        # fills the data cache under cache_path and stops, e.g. once before the trials of a sweep,
+        # no model is built so --distributed needs no process group here
+        prepare_data(args)
+        return
+
+    if args.distributed:
+        init_distributed()
+
+    for ii in range(args.itr):
+        # setting record of experiments
+        setting = '{}_{}_ft{}_sl{}_ll{}_pl{}_dm{}_nh{}_el{}_dl{}_df{}_at{}_fc{}_eb{}_dt{}_mx{}_{}_{}'.format(args.model, args.data, args.features, 
+                    args.seq_len, args.label_len, args.pred_len,
+                    args.d_model, args.n_heads, args.e_layers, args.d_layers, args.d_ff, args.attn, args.factor, 
+                    args.embed, args.distil, args.mix, args.des, ii)
+
+        exp = Exp(args) # set experiments
+        print('>>>>>>>start training : {}>>>>>>>>>>>>>>>>>>>>>>>>>>'.format(setting))
+        paused = []
+        def on_epoch(epoch, vali_loss):
+            if args.report and is_main_process():
+                with open(args.report, 'a') as f:
+                    f.write(json.dumps({'setting':setting, 'epoch':epoch, 'vali_loss':vali_loss})+'\n')
+            if 0 < args.stop_epoch <= epoch < args.train_epochs:
+                paused.append(epoch)
+                return False
+        exp.train(setting, callback=on_epoch)
+
+        if paused:
+            # resumed later from last.pth, tested once it has trained train_epochs
+            barrier()
+            continue
     
-    print('>>>>>>>testing : {}<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<'.format(setting))
-    exp.test(setting)
+        if not is_main_process():
+            # test, export and predict run on rank 0 alone, the others wait for it
+            barrier()
+            continue
+
+        print('>>>>>>>testing : {}<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<'.format(setting))
+        exp.test(setting)
+
+        if args.export:
+            path = os.path.join(args.checkpoints, setting)
+            print('>>>>>>>exporting : {}<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<'.format(setting))
+            export_model(args, os.path.join(path, 'checkpoint.pth')).save(os.path.join(path, 'model_script.pt'))
+
+        if args.do_predict:
+            print('>>>>>>>predicting : {}<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<'.format(setting))
+            exp.predict(setting, True)
+
+        barrier()
+        torch.cuda.empty_cache()
+
+    cleanup_distributed()
 
-    if args.do_predict:
-        print('>>>>>>>predicting : {}<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<'.format(setting))
-        exp.predict(setting, True)
+if __name__ == '__main__':
+    print('Args in experiment:')
+    print(args)
 
-    torch.cuda.empty_cache()
+    if args.distributed and not args.prepare_data and 'RANK' not in os.environ:
+        # local processes, torchrun sets RANK and the rest itself
+        launch(run, args.nproc, args)
+    else:
+        run(args)
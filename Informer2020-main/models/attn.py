@@ -2,10 +2,11 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-import numpy as np
+import time
 
-from math import sqrt
-from utils.masking import TriangularCausalMask, ProbMask
+from math import sqrt, log, ceil
+from typing import List, Optional, Tuple
+from utils.masking import causal_mask, prob_mask, position_arange
 
 class FullAttention(nn.Module):
     def __init__(self, mask_flag=True, factor=5, scale=None, attention_dropout=0.1, output_attention=False):
@@ -15,19 +16,23 @@ class FullAttention(nn.Module):
         self.output_attention = output_attention
         self.dropout = nn.Dropout(attention_dropout)
         
-    def forward(self, queries, keys, values, attn_mask):
+    def forward(self, queries, keys, values, attn_mask: Optional[torch.Tensor]) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        return self._full_attention(queries, keys, values, attn_mask)
+
+    def _full_attention(self, queries, keys, values, attn_mask: Optional[torch.Tensor]) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
         B, L, H, E = queries.shape
         _, S, _, D = values.shape
-        scale = self.scale or 1./sqrt(E)
+        scale = self.scale if self.scale is not None else 1./sqrt(E)
 
         scores = torch.einsum("blhe,bshe->bhls", queries, keys)
         if self.mask_flag:
             if attn_mask is None:
-                attn_mask = TriangularCausalMask(B, L, device=queries.device)
-
-            scores.masked_fill_(attn_mask.mask, -np.inf)
+                scores.masked_fill_(causal_mask(L, S, device=queries.device), float('-inf'))
+            else:
+                scores.masked_fill_(attn_mask, float('-inf'))
 
-        A = self.dropout(torch.softmax(scale * scores, dim=-1))
+        # softmax in float32, scores are bfloat16 under autocast
+        A = self.dropout(torch.softmax(scale * scores.float(), dim=-1))
         V = torch.einsum("bhls,bshd->blhd", A, values)
         
         if self.output_attention:
@@ -35,6 +40,50 @@ class FullAttention(nn.Module):
         else:
             return (V.contiguous(), None)
 
+class BlockAttention(FullAttention):
+    def __init__(self, mask_flag=True, factor=5, scale=None, attention_dropout=0.1, output_attention=False, block_size=128):
+        super(BlockAttention, self).__init__(mask_flag, factor, scale, attention_dropout, output_attention)
+        self.block_size = block_size
+
+    def forward(self, queries, keys, values, attn_mask: Optional[torch.Tensor]) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        # the full attention map is only needed when it is returned
+        if self.output_attention:
+            return self._full_attention(queries, keys, values, attn_mask)
+
+        B, L, H, E = queries.shape
+        _, S, _, D = values.shape
+        scale = self.scale if self.scale is not None else 1./sqrt(E)
+
+        # online softmax over blocks of keys, only [B, H, L, block_size] scores are alive at a time
+        q = queries.transpose(2,1) * scale
+        # running max, sum and output at least in float32, scores are bfloat16 under autocast
+        dtype = torch.promote_types(q.dtype, torch.float32)
+        row_max = torch.full([B, H, L, 1], float('-inf'), dtype=dtype, device=q.device)
+        row_sum = torch.zeros([B, H, L, 1], dtype=dtype, device=q.device)
+        out = torch.zeros([B, H, L, D], dtype=dtype, device=q.device)
+        for start in range(0, S, self.block_size):
+            end = min(start + self.block_size, S)
+            scores = torch.matmul(q, keys[:, start:end].permute(0, 2, 3, 1))
+            if self.mask_flag:
+                if attn_mask is None:
+                    block_mask = position_arange(S, device=q.device)[None, start:end] > \
+                                 position_arange(L, device=q.device)[:, None]
+                else:
+                    block_mask = attn_mask[..., start:end]
+                scores.masked_fill_(block_mask, float('-inf'))
+
+            new_max = torch.max(row_max, scores.max(-1, keepdim=True)[0])
+            new_max = new_max.masked_fill(torch.isinf(new_max), 0.)
+            correction = torch.exp(row_max - new_max)
+            p = torch.exp(scores - new_max)
+            row_sum = row_sum * correction + p.sum(-1, keepdim=True)
+            # dropout on the unnormalized weights equals dropout on the normalized attention
+            out = out * correction + torch.matmul(self.dropout(p), values[:, start:end].transpose(2,1))
+            row_max = new_max
+
+        V = (out / row_sum).transpose(2,1)
+        return (V.contiguous(), None)
+
 class ProbAttention(nn.Module):
     def __init__(self, mask_flag=True, factor=5, scale=None, attention_dropout=0.1, output_attention=False):
         super(ProbAttention, self).__init__()
@@ -43,31 +92,51 @@ class ProbAttention(nn.Module):
         self.mask_flag = mask_flag
         self.output_attention = output_attention
         self.dropout = nn.Dropout(attention_dropout)
+        # fixed key sampling for exported graphs, which have no RNG to replay
+        self.deterministic = False
+
+    def _sample_index(self, L_K: int, L_Q: int, sample_k: int, device: torch.device):
+        if self.deterministic:
+            # evenly spaced keys, shifted by the query position
+            offsets = torch.div(torch.arange(sample_k, device=device) * L_K, sample_k, rounding_mode='floor')
+            return (offsets[None, :] + torch.arange(L_Q, device=device)[:, None]) % L_K
+        return torch.randint(L_K, (L_Q, sample_k)).to(device)
 
-    def _prob_QK(self, Q, K, sample_k, n_top): # n_top: c*ln(L_q)
+    def _prob_QK(self, Q, K, sample_k: int, n_top: int): # n_top: c*ln(L_q)
         # Q [B, H, L, D]
         B, H, L_K, E = K.shape
         _, _, L_Q, _ = Q.shape
 
         # calculate the sampled Q_K
-        K_expand = K.unsqueeze(-3).expand(B, H, L_Q, L_K, E)
-        index_sample = torch.randint(L_K, (L_Q, sample_k)) # real U = U_part(factor*ln(L_k))*L_q
-        K_sample = K_expand[:, :, torch.arange(L_Q).unsqueeze(1), index_sample, :]
-        Q_K_sample = torch.matmul(Q.unsqueeze(-2), K_sample.transpose(-2, -1)).squeeze(-2)
+        index_sample = self._sample_index(L_K, L_Q, sample_k, Q.device) # real U = U_part(factor*ln(L_k))*L_q
+        Q_K_sample = self._sample_QK(Q, K, index_sample)
 
         # find the Top_k query with sparisty measurement
         M = Q_K_sample.max(-1)[0] - torch.div(Q_K_sample.sum(-1), L_K)
         M_top = M.topk(n_top, sorted=False)[1]
 
         # use the reduced Q to calculate Q_K
-        Q_reduce = Q[torch.arange(B)[:, None, None],
-                     torch.arange(H)[None, :, None],
-                     M_top, :] # factor*ln(L_q)
+        Q_reduce = Q.gather(2, M_top.unsqueeze(-1).expand(B, H, n_top, E)) # factor*ln(L_q)
         Q_K = torch.matmul(Q_reduce, K.transpose(-2, -1)) # factor*ln(L_q)*L_k
 
         return Q_K, M_top
 
-    def _get_initial_context(self, V, L_Q):
+    def _sample_QK(self, Q, K, index_sample):
+        # Q_K_sample[b, h, q, s] = Q[b, h, q] . K[b, h, index_sample[q, s]]
+        # without materializing K expanded to [B, H, L_Q, L_K, E]
+        B, H, L_K, E = K.shape
+        L_Q, sample_k = index_sample.shape
+
+        # gather the sampled key rows for a chunk of queries at a time, peak memory stays at the size of K
+        chunk = max(1, L_K // sample_k)
+        Q_K_sample = torch.jit.annotate(List[torch.Tensor], [])
+        for start in range(0, L_Q, chunk):
+            K_sample = K[:, :, index_sample[start:start+chunk], :]
+            Q_K_sample.append(torch.matmul(Q[:, :, start:start+chunk].unsqueeze(-2),
+                                           K_sample.transpose(-2, -1)).squeeze(-2))
+        return torch.cat(Q_K_sample, dim=-2)
+
+    def _get_initial_context(self, V, L_Q: int):
         B, H, L_V, D = V.shape
         if not self.mask_flag:
             # V_sum = V.sum(dim=-2)
@@ -75,29 +144,30 @@ class ProbAttention(nn.Module):
             contex = V_sum.unsqueeze(-2).expand(B, H, L_Q, V_sum.shape[-1]).clone()
         else: # use mask
             assert(L_Q == L_V) # requires that L_Q == L_V, i.e. for self-attention only
-            contex = V.cumsum(dim=-2)
+            # float32 running sum, bfloat16 loses the late positions under autocast
+            contex = V.cumsum(dim=-2, dtype=torch.float32)
         return contex
 
-    def _update_context(self, context_in, V, scores, index, L_Q, attn_mask):
+    def _update_context(self, context_in, V, scores, index, L_Q: int, attn_mask: Optional[torch.Tensor]) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
         B, H, L_V, D = V.shape
 
         if self.mask_flag:
-            attn_mask = ProbMask(B, H, L_Q, index, scores, device=V.device)
-            scores.masked_fill_(attn_mask.mask, -np.inf)
+            attn_mask = prob_mask(index, scores.shape[-1], device=V.device)
+            scores.masked_fill_(attn_mask, float('-inf'))
 
-        attn = torch.softmax(scores, dim=-1) # nn.Softmax(dim=-1)(scores)
+        attn = torch.softmax(scores.float(), dim=-1) # nn.Softmax(dim=-1)(scores)
 
-        context_in[torch.arange(B)[:, None, None],
-                   torch.arange(H)[None, :, None],
-                   index, :] = torch.matmul(attn, V).type_as(context_in)
+        u = index.shape[-1]
+        context_in.scatter_(2, index.unsqueeze(-1).expand(B, H, u, D),
+                            torch.matmul(attn, V).type_as(context_in))
         if self.output_attention:
             attns = (torch.ones([B, H, L_V, L_V])/L_V).type_as(attn).to(attn.device)
-            attns[torch.arange(B)[:, None, None], torch.arange(H)[None, :, None], index, :] = attn
+            attns.scatter_(2, index.unsqueeze(-1).expand(B, H, u, L_V), attn)
             return (context_in, attns)
         else:
             return (context_in, None)
 
-    def forward(self, queries, keys, values, attn_mask):
+    def forward(self, queries, keys, values, attn_mask: Optional[torch.Tensor]) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
         B, L_Q, H, D = queries.shape
         _, L_K, _, _ = keys.shape
 
@@ -105,8 +175,8 @@ class ProbAttention(nn.Module):
         keys = keys.transpose(2,1)
         values = values.transpose(2,1)
 
-        U_part = self.factor * np.ceil(np.log(L_K)).astype('int').item() # c*ln(L_k)
-        u = self.factor * np.ceil(np.log(L_Q)).astype('int').item() # c*ln(L_q) 
+        U_part = self.factor * int(ceil(log(L_K))) # c*ln(L_k)
+        u = self.factor * int(ceil(log(L_Q))) # c*ln(L_q)
 
         U_part = U_part if U_part<L_K else L_K
         u = u if u<L_Q else L_Q
@@ -114,9 +184,8 @@ class ProbAttention(nn.Module):
         scores_top, index = self._prob_QK(queries, keys, sample_k=U_part, n_top=u) 
 
         # add scale factor
-        scale = self.scale or 1./sqrt(D)
-        if scale is not None:
-            scores_top = scores_top * scale
+        scale = self.scale if self.scale is not None else 1./sqrt(D)
+        scores_top = scores_top * scale
         # get the context
         context = self._get_initial_context(values, L_Q)
         # update the context with selected top_k queries
@@ -125,7 +194,62 @@ class ProbAttention(nn.Module):
         return context.transpose(2,1).contiguous(), attn
 
 
+class AutoAttention(nn.Module):
+    # ProbAttention from threshold keys on, FullAttention below it where sampling, top-k
+    # and scatter cost more than the dense scores; chosen per call from the length the layer sees
+    def __init__(self, mask_flag=True, factor=5, scale=None, attention_dropout=0.1, output_attention=False, threshold=0):
+        super(AutoAttention, self).__init__()
+        self.prob = ProbAttention(mask_flag, factor, scale, attention_dropout, output_attention)
+        self.full = FullAttention(mask_flag, factor, scale, attention_dropout, output_attention)
+        self.mask_flag = mask_flag
+        self.threshold = threshold
+        # saved with the checkpoint, forward reads the python int
+        self.register_buffer('calibrated_threshold', torch.tensor(threshold))
+
+    def set_threshold(self, threshold):
+        self.threshold = threshold
+        self.calibrated_threshold.fill_(threshold)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        super(AutoAttention, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+        self.threshold = int(self.calibrated_threshold)
+
+    def forward(self, queries, keys, values, attn_mask: Optional[torch.Tensor]) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        if keys.shape[1] >= self.threshold:
+            return self.prob(queries, keys, values, attn_mask)
+        return self.full(queries, keys, values, attn_mask)
+
+def calibrate_threshold(mask_flag, factor, n_heads, d_keys, batch_size, max_len, device, repeat=3):
+    # shortest length from which ProbAttention beats FullAttention at every longer length tried
+    prob = ProbAttention(mask_flag, factor, attention_dropout=0.).eval()
+    full = FullAttention(mask_flag, factor, attention_dropout=0.).eval()
+    lens = [16]
+    while lens[-1] < max_len:
+        lens.append(lens[-1]*2)
+
+    def timed(attn, q):
+        attn(q, q, q, None)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(repeat):
+            attn(q, q, q, None)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        return time.time() - start
+
+    threshold = lens[-1] + 1
+    with torch.no_grad():
+        for L in reversed(lens):
+            q = torch.randn(batch_size, L, n_heads, d_keys, device=device)
+            if timed(prob, q) >= timed(full, q):
+                break
+            threshold = L
+    return threshold
+
 class AttentionLayer(nn.Module):
+    __constants__ = ['slice_qkv']
+
     def __init__(self, attention, d_model, n_heads, 
                  d_keys=None, d_values=None, mix=False):
         super(AttentionLayer, self).__init__()
@@ -134,21 +258,72 @@ class AttentionLayer(nn.Module):
         d_values = d_values or (d_model//n_heads)
 
         self.inner_attention = attention
-        self.query_projection = nn.Linear(d_model, d_keys * n_heads)
-        self.key_projection = nn.Linear(d_model, d_keys * n_heads)
-        self.value_projection = nn.Linear(d_model, d_values * n_heads)
+        # query/key/value projections stacked in one linear, self-attention projects with a single GEMM
+        self.qkv_projection = nn.Linear(d_model, (2 * d_keys + d_values) * n_heads)
+        self.query_projection = None
+        self.key_projection = None
+        self.value_projection = None
         self.out_projection = nn.Linear(d_values * n_heads, d_model)
+        self.qkv_sizes = [d_keys * n_heads, d_keys * n_heads, d_values * n_heads]
+        # cross attention slices the stacked weight, cleared once it is quantized
+        self.slice_qkv = True
         self.n_heads = n_heads
         self.mix = mix
 
-    def forward(self, queries, keys, values, attn_mask):
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints with separate query/key/value projections
+        names = ['query_projection', 'key_projection', 'value_projection']
+        if self.qkv_projection is not None and prefix+'query_projection.weight' in state_dict:
+            for param in ['weight', 'bias']:
+                state_dict[prefix+'qkv_projection.'+param] = torch.cat(
+                    [state_dict.pop(prefix+name+'.'+param) for name in names], dim=0)
+        super(AttentionLayer, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def unfuse(self):
+        # back to separate query/key/value linears, e.g. for quantized cross attention
+        # where the stacked weight cannot be sliced
+        q_size, k_size, v_size = self.qkv_sizes
+        projections = []
+        for start, end in [(0, q_size), (q_size, q_size+k_size), (q_size+k_size, q_size+k_size+v_size)]:
+            linear = nn.Linear(self.qkv_projection.in_features, end - start)
+            with torch.no_grad():
+                linear.weight.copy_(self.qkv_projection.weight[start:end])
+                linear.bias.copy_(self.qkv_projection.bias[start:end])
+            projections.append(linear.to(self.qkv_projection.weight.device))
+        self.query_projection, self.key_projection, self.value_projection = projections
+        self.qkv_projection = None
+
+    def _project(self, queries, keys, values):
+        if self.qkv_projection is None:
+            return self.query_projection(queries), self.key_projection(keys), self.value_projection(values)
+
+        if self.slice_qkv:
+            if not (queries is keys and keys is values):
+                return self._project_sliced(queries, keys, values)
+        # quantized stacked projections have no weight to slice, they only serve self-attention
+        qkv = self.qkv_projection(queries).split(self.qkv_sizes, dim=-1)
+        return qkv[0], qkv[1], qkv[2]
+
+    def _project_sliced(self, queries, keys, values):
+        q_size, k_size, v_size = self.qkv_sizes
+        weight, bias = self.qkv_projection.weight, self.qkv_projection.bias
+        queries = F.linear(queries, weight[:q_size], bias[:q_size])
+        if keys is values:
+            kv = F.linear(keys, weight[q_size:], bias[q_size:]).split([k_size, v_size], dim=-1)
+            return queries, kv[0], kv[1]
+        keys = F.linear(keys, weight[q_size:q_size+k_size], bias[q_size:q_size+k_size])
+        values = F.linear(values, weight[q_size+k_size:], bias[q_size+k_size:])
+        return queries, keys, values
+
+    def forward(self, queries, keys, values, attn_mask: Optional[torch.Tensor]) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
         B, L, _ = queries.shape
         _, S, _ = keys.shape
         H = self.n_heads
 
-        queries = self.query_projection(queries).view(B, L, H, -1)
-        keys = self.key_projection(keys).view(B, S, H, -1)
-        values = self.value_projection(values).view(B, S, H, -1)
+        queries, keys, values = self._project(queries, keys, values)
+        queries = queries.view(B, L, H, -1)
+        keys = keys.view(B, S, H, -1)
+        values = values.view(B, S, H, -1)
 
         out, attn = self.inner_attention(
             queries,
@@ -2,6 +2,9 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from typing import Optional
+from models.encoder import LayerNorm
+
 class DecoderLayer(nn.Module):
     def __init__(self, self_attention, cross_attention, d_model, d_ff=None,
                  dropout=0.1, activation="relu"):
@@ -11,13 +14,13 @@ class DecoderLayer(nn.Module):
         self.cross_attention = cross_attention
         self.conv1 = nn.Conv1d(in_channels=d_model, out_channels=d_ff, kernel_size=1)
         self.conv2 = nn.Conv1d(in_channels=d_ff, out_channels=d_model, kernel_size=1)
-        self.norm1 = nn.LayerNorm(d_model)
-        self.norm2 = nn.LayerNorm(d_model)
-        self.norm3 = nn.LayerNorm(d_model)
+        self.norm1 = LayerNorm(d_model)
+        self.norm2 = LayerNorm(d_model)
+        self.norm3 = LayerNorm(d_model)
         self.dropout = nn.Dropout(dropout)
-        self.activation = F.relu if activation == "relu" else F.gelu
+        self.activation = nn.ReLU() if activation == "relu" else nn.GELU()
 
-    def forward(self, x, cross, x_mask=None, cross_mask=None):
+    def forward(self, x, cross, x_mask: Optional[torch.Tensor]=None, cross_mask: Optional[torch.Tensor]=None):
         x = x + self.dropout(self.self_attention(
             x, x, x,
             attn_mask=x_mask
@@ -41,7 +44,7 @@ class Decoder(nn.Module):
         self.layers = nn.ModuleList(layers)
         self.norm = norm_layer
 
-    def forward(self, x, cross, x_mask=None, cross_mask=None):
+    def forward(self, x, cross, x_mask: Optional[torch.Tensor]=None, cross_mask: Optional[torch.Tensor]=None):
         for layer in self.layers:
             x = layer(x, cross, x_mask=x_mask, cross_mask=cross_mask)
 
@@ -4,6 +4,9 @@ import torch.nn.functional as F
 
 import math
 
+# numeric (major, minor), comparing version strings puts '1.10' before '1.5'
+TORCH_VERSION = tuple(int(v) for v in torch.__version__.split('+')[0].split('.')[:2])
+
 class PositionalEmbedding(nn.Module):
     def __init__(self, d_model, max_len=5000):
         super(PositionalEmbedding, self).__init__()
@@ -26,7 +29,7 @@ class PositionalEmbedding(nn.Module):
 class TokenEmbedding(nn.Module):
     def __init__(self, c_in, d_model):
         super(TokenEmbedding, self).__init__()
-        padding = 1 if torch.__version__>='1.5.0' else 2
+        padding = 1 if TORCH_VERSION>=(1, 5) else 2
         self.tokenConv = nn.Conv1d(in_channels=c_in, out_channels=d_model, 
                                     kernel_size=3, padding=padding, padding_mode='circular')
         for m in self.modules():
@@ -64,8 +67,7 @@ class TemporalEmbedding(nn.Module):
         weekday_size = 7; day_size = 32; month_size = 13
 
         Embed = FixedEmbedding if embed_type=='fixed' else nn.Embedding
-        if freq=='t':
-            self.minute_embed = Embed(minute_size, d_model)
+        self.minute_embed = Embed(minute_size, d_model) if freq=='t' else None
         self.hour_embed = Embed(hour_size, d_model)
         self.weekday_embed = Embed(weekday_size, d_model)
         self.day_embed = Embed(day_size, d_model)
@@ -74,13 +76,40 @@ class TemporalEmbedding(nn.Module):
     def forward(self, x):
         x = x.long()
         
-        minute_x = self.minute_embed(x[:,:,4]) if hasattr(self, 'minute_embed') else 0.
         hour_x = self.hour_embed(x[:,:,3])
         weekday_x = self.weekday_embed(x[:,:,2])
         day_x = self.day_embed(x[:,:,1])
         month_x = self.month_embed(x[:,:,0])
         
-        return hour_x + weekday_x + day_x + month_x + minute_x
+        out = hour_x + weekday_x + day_x + month_x
+        if self.minute_embed is not None:
+            out = out + self.minute_embed(x[:,:,4])
+        return out
+
+class FusedTemporalEmbedding(nn.Module):
+    '''
+    fixed TemporalEmbedding on packed calendar keys (timeenc=2), the frozen month, day and weekday
+    tables and the hour and minute tables are summed once so a token costs two gathers. One table
+    over all fields would have 13*32*7*24*4 rows.
+    '''
+    def __init__(self, d_model, freq='h'):
+        super(FusedTemporalEmbedding, self).__init__()
+
+        minute_size = 4; hour_size = 24
+        weekday_size = 7; day_size = 32; month_size = 13
+
+        table = lambda size: FixedEmbedding(size, d_model).emb.weight.data
+        minute = table(minute_size) if freq=='t' else torch.zeros(minute_size, d_model)
+        # key = date*96 + time, date = (month*32 + day)*7 + weekday, time = hour*4 + minute
+        date = table(month_size)[:,None,None] + table(day_size)[None,:,None] + table(weekday_size)[None,None,:]
+        time = table(hour_size)[:,None] + minute[None,:]
+        self.register_buffer('date_table', date.reshape(-1, d_model), persistent=False)
+        self.register_buffer('time_table', time.reshape(-1, d_model), persistent=False)
+        self.time_size = hour_size * minute_size
+
+    def forward(self, x):
+        key = x[:,:,0]
+        return F.embedding(key // self.time_size, self.date_table) + F.embedding(key % self.time_size, self.time_table)
 
 class TimeFeatureEmbedding(nn.Module):
     def __init__(self, d_model, embed_type='timeF', freq='h'):
@@ -99,7 +128,12 @@ class DataEmbedding(nn.Module):
 
         self.value_embedding = TokenEmbedding(c_in=c_in, d_model=d_model)
         self.position_embedding = PositionalEmbedding(d_model=d_model)
-        self.temporal_embedding = TemporalEmbedding(d_model=d_model, embed_type=embed_type, freq=freq) if embed_type!='timeF' else TimeFeatureEmbedding(d_model=d_model, embed_type=embed_type, freq=freq)
+        if embed_type=='timeF':
+            self.temporal_embedding = TimeFeatureEmbedding(d_model=d_model, embed_type=embed_type, freq=freq)
+        elif embed_type=='fused':
+            self.temporal_embedding = FusedTemporalEmbedding(d_model=d_model, freq=freq)
+        else:
+            self.temporal_embedding = TemporalEmbedding(d_model=d_model, embed_type=embed_type, freq=freq)
 
         self.dropout = nn.Dropout(p=dropout)
 
@@ -2,10 +2,20 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+from models.embed import TORCH_VERSION
+from utils.masking import is_compiling
+
+class LayerNorm(nn.LayerNorm):
+    # computed and returned in float32 under bfloat16 autocast, the residual stream stays float32
+    def forward(self, x):
+        return F.layer_norm(x.float(), self.normalized_shape, self.weight, self.bias, self.eps)
+
 class ConvLayer(nn.Module):
     def __init__(self, c_in):
         super(ConvLayer, self).__init__()
-        padding = 1 if torch.__version__>='1.5.0' else 2
+        padding = 1 if TORCH_VERSION>=(1, 5) else 2
         self.downConv = nn.Conv1d(in_channels=c_in,
                                   out_channels=c_in,
                                   kernel_size=3,
@@ -30,12 +40,12 @@ class EncoderLayer(nn.Module):
         self.attention = attention
         self.conv1 = nn.Conv1d(in_channels=d_model, out_channels=d_ff, kernel_size=1)
         self.conv2 = nn.Conv1d(in_channels=d_ff, out_channels=d_model, kernel_size=1)
-        self.norm1 = nn.LayerNorm(d_model)
-        self.norm2 = nn.LayerNorm(d_model)
+        self.norm1 = LayerNorm(d_model)
+        self.norm2 = LayerNorm(d_model)
         self.dropout = nn.Dropout(dropout)
-        self.activation = F.relu if activation == "relu" else F.gelu
+        self.activation = nn.ReLU() if activation == "relu" else nn.GELU()
 
-    def forward(self, x, attn_mask=None):
+    def forward(self, x, attn_mask: Optional[torch.Tensor]=None):
         # x [B, L, D]
         # x = x + self.dropout(self.attention(
         #     x, x, x,
@@ -60,9 +70,9 @@ class Encoder(nn.Module):
         self.conv_layers = nn.ModuleList(conv_layers) if conv_layers is not None else None
         self.norm = norm_layer
 
-    def forward(self, x, attn_mask=None):
+    def forward(self, x, attn_mask: Optional[torch.Tensor]=None):
         # x [B, L, D]
-        attns = []
+        attns = torch.jit.annotate(List[Optional[torch.Tensor]], [])
         if self.conv_layers is not None:
             for attn_layer, conv_layer in zip(self.attn_layers, self.conv_layers):
                 x, attn = attn_layer(x, attn_mask=attn_mask)
@@ -81,18 +91,60 @@ class Encoder(nn.Module):
         return x, attns
 
 class EncoderStack(nn.Module):
-    def __init__(self, encoders, inp_lens):
+    __constants__ = ['inp_lens']
+
+    def __init__(self, encoders, inp_lens, concurrent=False):
         super(EncoderStack, self).__init__()
         self.encoders = nn.ModuleList(encoders)
         self.inp_lens = inp_lens
+        # run the sub-encoders at the same time instead of one after another
+        self.concurrent = concurrent
+
+    @torch.jit.unused
+    def _forward_threads(self, x):
+        # eager mode: one python thread per sub-encoder, from a pool that lives for this call. They share
+        # the intra-op threads, torch.set_num_threads is process wide and is left to the caller.
+        # grad and inference mode and autocast are thread local, so the caller's are passed on to the workers
+        grad, inference = torch.is_grad_enabled(), torch.is_inference_mode_enabled()
+        device = x.device.type
+        autocast, autocast_dtype = torch.is_autocast_enabled(device), torch.get_autocast_dtype(device)
+        inps = [x[:, -(x.shape[1] >> i_len):, :] for i_len in self.inp_lens]
+
+        def run(encoder, inp):
+            with torch.inference_mode(inference), torch.set_grad_enabled(grad), \
+                 torch.autocast(device, dtype=autocast_dtype, enabled=autocast):
+                return encoder(inp)
 
-    def forward(self, x, attn_mask=None):
+        with ThreadPoolExecutor(max_workers=len(self.encoders)) as pool:
+            outs = list(pool.map(run, self.encoders, inps))
+        return torch.cat([x_s for x_s, _ in outs], -2), [attn for _, attn in outs]
+
+    def _forward_fork(self, x):
+        # TorchScript: fork/join on the inter-op thread pool
+        futures = torch.jit.annotate(List[torch.jit.Future[Tuple[torch.Tensor, List[Optional[torch.Tensor]]]]], [])
+        for i_len, encoder in zip(self.inp_lens, self.encoders):
+            inp_len = x.shape[1] >> i_len # x.shape[1]//(2**i_len)
+            futures.append(torch.jit.fork(encoder, x[:, -inp_len:, :]))
+        x_stack = torch.jit.annotate(List[torch.Tensor], [])
+        attns = torch.jit.annotate(List[List[Optional[torch.Tensor]]], [])
+        for future in futures:
+            x_s, attn = torch.jit.wait(future)
+            x_stack.append(x_s); attns.append(attn)
+        return torch.cat(x_stack, -2), attns
+
+    def forward(self, x, attn_mask: Optional[torch.Tensor]=None):
         # x [B, L, D]
-        x_stack = []; attns = []
+        if self.concurrent:
+            if torch.jit.is_scripting():
+                return self._forward_fork(x)
+            elif not torch.jit.is_tracing() and not is_compiling():
+                return self._forward_threads(x)
+
+        x_stack = torch.jit.annotate(List[torch.Tensor], [])
+        attns = torch.jit.annotate(List[List[Optional[torch.Tensor]]], [])
         for i_len, encoder in zip(self.inp_lens, self.encoders):
-            inp_len = x.shape[1]//(2**i_len)
+            inp_len = x.shape[1] >> i_len # x.shape[1]//(2**i_len)
             x_s, attn = encoder(x[:, -inp_len:, :])
             x_stack.append(x_s); attns.append(attn)
-        x_stack = torch.cat(x_stack, -2)
         
-        return x_stack, attns
+        return torch.cat(x_stack, -2), attns
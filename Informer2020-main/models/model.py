@@ -2,13 +2,15 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from utils.masking import TriangularCausalMask, ProbMask
-from models.encoder import Encoder, EncoderLayer, ConvLayer, EncoderStack
+from typing import Optional
+from models.encoder import Encoder, EncoderLayer, ConvLayer, EncoderStack, LayerNorm
 from models.decoder import Decoder, DecoderLayer
-from models.attn import FullAttention, ProbAttention, AttentionLayer
+from models.attn import FullAttention, BlockAttention, ProbAttention, AutoAttention, AttentionLayer
 from models.embed import DataEmbedding
 
 class Informer(nn.Module):
+    __constants__ = ['output_attention']
+
     def __init__(self, enc_in, dec_in, c_out, seq_len, label_len, out_len, 
                 factor=5, d_model=512, n_heads=8, e_layers=3, d_layers=2, d_ff=512, 
                 dropout=0.0, attn='prob', embed='fixed', freq='h', activation='gelu', 
@@ -23,7 +25,8 @@ class Informer(nn.Module):
         self.enc_embedding = DataEmbedding(enc_in, d_model, embed, freq, dropout)
         self.dec_embedding = DataEmbedding(dec_in, d_model, embed, freq, dropout)
         # Attention
-        Attn = ProbAttention if attn=='prob' else FullAttention
+        Attn = {'prob':ProbAttention, 'block':BlockAttention, 'auto':AutoAttention}.get(attn, FullAttention)
+        CrossAttn = BlockAttention if attn=='block' else FullAttention
         # Encoder
         self.encoder = Encoder(
             [
@@ -41,7 +44,7 @@ class Informer(nn.Module):
                     d_model
                 ) for l in range(e_layers-1)
             ] if distil else None,
-            norm_layer=torch.nn.LayerNorm(d_model)
+            norm_layer=LayerNorm(d_model)
         )
         # Decoder
         self.decoder = Decoder(
@@ -49,7 +52,7 @@ class Informer(nn.Module):
                 DecoderLayer(
                     AttentionLayer(Attn(True, factor, attention_dropout=dropout, output_attention=False), 
                                 d_model, n_heads, mix=mix),
-                    AttentionLayer(FullAttention(False, factor, attention_dropout=dropout, output_attention=False), 
+                    AttentionLayer(CrossAttn(False, factor, attention_dropout=dropout, output_attention=False), 
                                 d_model, n_heads, mix=False),
                     d_model,
                     d_ff,
@@ -58,14 +61,14 @@ class Informer(nn.Module):
                 )
                 for l in range(d_layers)
             ],
-            norm_layer=torch.nn.LayerNorm(d_model)
+            norm_layer=LayerNorm(d_model)
         )
         # self.end_conv1 = nn.Conv1d(in_channels=label_len+out_len, out_channels=out_len, kernel_size=1, bias=True)
         # self.end_conv2 = nn.Conv1d(in_channels=d_model, out_channels=c_out, kernel_size=1, bias=True)
         self.projection = nn.Linear(d_model, c_out, bias=True)
         
     def forward(self, x_enc, x_mark_enc, x_dec, x_mark_dec, 
-                enc_self_mask=None, dec_self_mask=None, dec_enc_mask=None):
+                enc_self_mask: Optional[torch.Tensor]=None, dec_self_mask: Optional[torch.Tensor]=None, dec_enc_mask: Optional[torch.Tensor]=None):
         enc_out = self.enc_embedding(x_enc, x_mark_enc)
         enc_out, attns = self.encoder(enc_out, attn_mask=enc_self_mask)
 
@@ -82,11 +85,13 @@ class Informer(nn.Module):
 
 
 class InformerStack(nn.Module):
+    __constants__ = ['output_attention']
+
     def __init__(self, enc_in, dec_in, c_out, seq_len, label_len, out_len, 
                 factor=5, d_model=512, n_heads=8, e_layers=[3,2,1], d_layers=2, d_ff=512, 
                 dropout=0.0, attn='prob', embed='fixed', freq='h', activation='gelu',
                 output_attention = False, distil=True, mix=True,
-                device=torch.device('cuda:0')):
+                device=torch.device('cuda:0'), concurrent=False):
         super(InformerStack, self).__init__()
         self.pred_len = out_len
         self.attn = attn
@@ -96,7 +101,8 @@ class InformerStack(nn.Module):
         self.enc_embedding = DataEmbedding(enc_in, d_model, embed, freq, dropout)
         self.dec_embedding = DataEmbedding(dec_in, d_model, embed, freq, dropout)
         # Attention
-        Attn = ProbAttention if attn=='prob' else FullAttention
+        Attn = {'prob':ProbAttention, 'block':BlockAttention, 'auto':AutoAttention}.get(attn, FullAttention)
+        CrossAttn = BlockAttention if attn=='block' else FullAttention
         # Encoder
 
         inp_lens = list(range(len(e_layers))) # [0,1,2,...] you can customize here
@@ -117,16 +123,16 @@ class InformerStack(nn.Module):
                         d_model
                     ) for l in range(el-1)
                 ] if distil else None,
-                norm_layer=torch.nn.LayerNorm(d_model)
+                norm_layer=LayerNorm(d_model)
             ) for el in e_layers]
-        self.encoder = EncoderStack(encoders, inp_lens)
+        self.encoder = EncoderStack(encoders, inp_lens, concurrent)
         # Decoder
         self.decoder = Decoder(
             [
                 DecoderLayer(
                     AttentionLayer(Attn(True, factor, attention_dropout=dropout, output_attention=False), 
                                 d_model, n_heads, mix=mix),
-                    AttentionLayer(FullAttention(False, factor, attention_dropout=dropout, output_attention=False), 
+                    AttentionLayer(CrossAttn(False, factor, attention_dropout=dropout, output_attention=False), 
                                 d_model, n_heads, mix=False),
                     d_model,
                     d_ff,
@@ -135,14 +141,14 @@ class InformerStack(nn.Module):
                 )
                 for l in range(d_layers)
             ],
-            norm_layer=torch.nn.LayerNorm(d_model)
+            norm_layer=LayerNorm(d_model)
         )
         # self.end_conv1 = nn.Conv1d(in_channels=label_len+out_len, out_channels=out_len, kernel_size=1, bias=True)
         # self.end_conv2 = nn.Conv1d(in_channels=d_model, out_channels=c_out, kernel_size=1, bias=True)
         self.projection = nn.Linear(d_model, c_out, bias=True)
         
     def forward(self, x_enc, x_mark_enc, x_dec, x_mark_dec, 
-                enc_self_mask=None, dec_self_mask=None, dec_enc_mask=None):
+                enc_self_mask: Optional[torch.Tensor]=None, dec_self_mask: Optional[torch.Tensor]=None, dec_enc_mask: Optional[torch.Tensor]=None):
         enc_out = self.enc_embedding(x_enc, x_mark_enc)
         enc_out, attns = self.encoder(enc_out, attn_mask=enc_self_mask)
 
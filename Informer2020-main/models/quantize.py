@@ -0,0 +1,42 @@
+import copy
+
+import torch
+import torch.nn as nn
+
+from models.attn import AttentionLayer
+from models.decoder import DecoderLayer
+
+class PointwiseConv(nn.Module):
+    # 1x1 nn.Conv1d computed as nn.Linear over the channel dim, so dynamic quantization picks it up
+    def __init__(self, conv):
+        super(PointwiseConv, self).__init__()
+        self.linear = nn.Linear(conv.in_channels, conv.out_channels, bias=conv.bias is not None)
+        with torch.no_grad():
+            self.linear.weight.copy_(conv.weight.squeeze(-1))
+            if conv.bias is not None:
+                self.linear.bias.copy_(conv.bias)
+
+    def forward(self, x):
+        # x [B, C, L]
+        return self.linear(x.transpose(-1, 1)).transpose(-1, 1)
+
+def quantize_model(model, dtype=torch.qint8):
+    # dynamic int8 copy of Informer/InformerStack for CPU inference:
+    # attention projections, feed-forward 1x1 convs and the output projection
+    model = copy.deepcopy(model).cpu().eval()
+    # cross attention projects queries and keys separately, a quantized stacked weight cannot be sliced
+    for module in model.modules():
+        if isinstance(module, DecoderLayer) and module.cross_attention.qkv_projection is not None:
+            module.cross_attention.unfuse()
+    for module in model.modules():
+        if isinstance(module, AttentionLayer):
+            module.slice_qkv = False
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, nn.Conv1d) and child.kernel_size == (1,) and child.groups == 1:
+                setattr(module, name, PointwiseConv(child))
+
+    # the embeddings see raw inputs with few channels, they stay in float
+    layers = set(name for name, module in model.named_modules()
+                 if isinstance(module, nn.Linear) and not name.startswith(('enc_embedding', 'dec_embedding')))
+    return torch.ao.quantization.quantize_dynamic(model, layers, dtype=dtype)
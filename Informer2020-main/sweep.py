@@ -0,0 +1,317 @@
+import argparse
+import itertools
+import json
+import os
+import queue
+import random
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+parser = argparse.ArgumentParser(description='[Informer] Hyperparameter sweep over main_informer.py')
+
+parser.add_argument('--spec', type=str, required=True, help='json sweep spec, e.g. scripts/sweep_solar.json')
+parser.add_argument('--workers', type=int, default=2, help='trials run at the same time, the cores are split between them')
+parser.add_argument('--time_budget', type=float, default=0, help='seconds after which no trial is started and running ones are stopped, 0 for no limit')
+parser.add_argument('--sort', type=str, default='mse', help='metric the result table is sorted by, options:[mae, mse, rmse, mape, mspe]')
+parser.add_argument('--scheduler', type=str, default='none', help='early termination of trials, options:[none, asha]')
+parser.add_argument('--min_epochs', type=int, default=1, help='epochs every trial trains before asha compares it')
+parser.add_argument('--eta', type=int, default=3, help='asha promotes the best 1/eta of a rung to eta times as many epochs')
+parser.add_argument('--log_path', type=str, default='./sweeps/', help='location of the trial logs and the result table')
+
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main_informer.py')
+# main_informer.py options the preprocessed data depends on, see data_loader._cache_options
+CACHE_ARGS = ['data', 'root_path', 'data_path', 'features', 'target', 'freq', 'embed', 'cols', 'cache_path', 'chunk_size']
+# main_informer.py default of train_epochs
+TRAIN_EPOCHS = 6
+# order of the results/<setting>/metrics.npy entries
+METRICS = ['mae', 'mse', 'rmse', 'mape', 'mspe']
+
+def sample_trials(spec):
+    '''
+    list of {option: value} dicts of spec['params']. The grid method takes every combination of
+    the value lists, random draws spec['trials'] of them: a value list is sampled uniformly and a
+    {"min", "max", "log"} range continuously, as int when both ends are ints.
+    '''
+    params = spec['params']
+    if spec.get('method', 'grid') == 'grid':
+        assert all(isinstance(v, list) for v in params.values()), 'grid sweeps take value lists only'
+        names = list(params)
+        return [dict(zip(names, values)) for values in itertools.product(*[params[n] for n in names])]
+
+    rng = random.Random(spec.get('seed', 0))
+    trials = []
+    for _ in range(spec['trials']):
+        trial = {}
+        for name, values in params.items():
+            if isinstance(values, dict):
+                low, high = values['min'], values['max']
+                if values.get('log', False):
+                    value = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+                else:
+                    value = rng.uniform(low, high)
+                if isinstance(low, int) and isinstance(high, int):
+                    value = int(round(value))
+            else:
+                value = rng.choice(values)
+            trial[name] = value
+        trials.append(trial)
+    return trials
+
+def to_argv(options):
+    # main_informer.py command line, a flag is passed when its value is true as it would be typed
+    argv = []
+    for name, value in options.items():
+        if value is True:
+            argv.append('--'+name)
+        elif isinstance(value, list):
+            argv += ['--'+name] + [str(v) for v in value]
+        elif value is not False and value is not None:
+            argv += ['--'+name, str(value)]
+    return argv
+
+def core_slots(workers):
+    # disjoint core sets of the workers, one core each when there are more workers than cores
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count()))
+    if workers >= len(cores):
+        return [[cores[i % len(cores)]] for i in range(workers)]
+    n = len(cores) // workers
+    return [cores[i*n:(i+1)*n] for i in range(workers)]
+
+def run_trial(argv, cores, log_file, timeout=None, append=False):
+    # main_informer.py in a child process with as many intra-op threads as cores, returns its status.
+    # The child pins itself to INFORMER_CORES, preexec_fn is not safe with the runner's threads
+    env = dict(os.environ, OMP_NUM_THREADS=str(len(cores)), MKL_NUM_THREADS=str(len(cores)),
+               INFORMER_CORES=','.join(str(c) for c in cores))
+    with open(log_file, 'a' if append else 'w') as log:
+        try:
+            proc = subprocess.run([sys.executable, '-u', MAIN] + argv, stdout=log, stderr=subprocess.STDOUT,
+                                  env=env, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            return 'timeout'
+    return 'done' if proc.returncode == 0 else 'failed'
+
+def read_metrics(settings, results_path='./results/'):
+    # metrics of the given settings, the itr runs of a trial, averaged; nan when none were tested
+    files = [os.path.join(results_path, setting, 'metrics.npy') for setting in settings]
+    files = [f for f in files if os.path.exists(f)]
+    if not files:
+        return {name:np.nan for name in METRICS}
+    return dict(zip(METRICS, np.mean([np.load(f) for f in files], axis=0)))
+
+def read_report(report_file):
+    '''
+    {epoch: vali_loss} of the json lines main_informer.py --report appended, averaged over itr
+    runs, and the settings of those runs, i.e. the results folders this trial writes
+    '''
+    losses = {}; settings = []
+    if os.path.exists(report_file):
+        with open(report_file) as f:
+            for line in f:
+                entry = json.loads(line)
+                losses.setdefault(entry['epoch'], {})[entry['setting']] = entry['vali_loss']
+                if entry['setting'] not in settings:
+                    settings.append(entry['setting'])
+    return {epoch:float(np.mean(list(runs.values()))) for epoch, runs in losses.items()}, settings
+
+class SuccessiveHalving():
+    '''
+    asynchronous successive halving (ASHA). Trials train min_epochs and pause. Rung k is reached
+    after min_epochs*eta**k epochs, capped at train_epochs. A paused trial whose best vali loss is
+    in the top 1/eta of all trials that reached its rung is resumed from its last.pth up to the
+    next rung. Free workers take promotions before they start new trials, the others stay paused.
+    '''
+    def __init__(self, train_epochs, min_epochs=1, eta=3):
+        self.eta = eta
+        self.rungs = []
+        epochs = min_epochs
+        while epochs < train_epochs:
+            self.rungs.append(epochs)
+            epochs *= eta
+        self.rungs.append(train_epochs)
+
+    def rung(self, trial):
+        # highest rung the trial has trained through, -1 before the first
+        return max([k for k, epochs in enumerate(self.rungs) if epochs <= trial['epochs']], default=-1)
+
+    def score(self, trial, k):
+        return min(loss for epoch, loss in trial['losses'].items() if epoch <= self.rungs[k])
+
+    def next_job(self, trials):
+        for k in reversed(range(len(self.rungs)-1)):
+            reached = [t for t in trials if self.rung(t) >= k]
+            top = sorted(reached, key=lambda t: self.score(t, k))[:len(reached)//self.eta]
+            for trial in top:
+                if trial['status'] == 'paused' and self.rung(trial) == k:
+                    return trial, self.rungs[k+1]
+        for trial in trials:
+            if trial['status'] == 'pending':
+                return trial, self.rungs[0]
+        return None
+
+class Sweep():
+    '''
+    trials of main_informer.py sampled from a spec, run `workers` at a time as child processes on
+    their own cores. Every trial reads the data through the same cache_path, which is filled once
+    per data configuration before the trials start. A trial's des is <name>_t<k>, so its
+    checkpoints and results folders are its own. With a scheduler, trials are paused at the epoch
+    it asks for and resumed from their checkpoints when it picks them again.
+    '''
+    def __init__(self, spec, name, workers=2, time_budget=0, log_path='./sweeps/', scheduler=None):
+        self.name = name
+        self.options = dict(spec.get('args', {}))
+        self.workers = workers
+        self.time_budget = time_budget
+        self.log_path = log_path
+        self.scheduler = scheduler
+        self.trials = [{'trial':'{}_t{:03d}'.format(name, k), 'params':params, 'status':'pending',
+                        'seconds':0., 'epochs':0, 'losses':{}, 'settings':[]}
+                       for k, params in enumerate(sample_trials(spec))]
+
+    def trial_options(self, trial):
+        options = dict(self.options)
+        options.update(trial['params'])
+        options['des'] = trial['trial']
+        return options
+
+    def prepare(self):
+        # one --prepare_data run per distinct data configuration, on all cores
+        cores = core_slots(1)[0]
+        configs = {}
+        for trial in self.trials:
+            options = {k:v for k, v in self.trial_options(trial).items() if k in CACHE_ARGS}
+            configs[json.dumps(options, sort_keys=True)] = options
+        for k, options in enumerate(configs.values()):
+            log_file = os.path.join(self.log_path, '{}_data{}.log'.format(self.name, k))
+            status = run_trial(to_argv(options) + ['--prepare_data'], cores, log_file)
+            assert status == 'done', 'preparing the data failed, see {}'.format(log_file)
+
+    def next_job(self):
+        # (trial, epoch to pause after or None), None when nothing can start now
+        if self.scheduler is not None:
+            return self.scheduler.next_job(self.trials)
+        for trial in self.trials:
+            if trial['status'] == 'pending':
+                return trial, None
+        return None
+
+    def job_options(self, trial, stop_epoch):
+        # main_informer.py options of the next run of trial, resumed when it has trained before
+        options = self.trial_options(trial)
+        report_file = os.path.join(self.log_path, trial['trial']+'.jsonl')
+        options['report'] = report_file
+        if trial['epochs'] > 0:
+            options['resume'] = True
+        elif os.path.exists(report_file):
+            os.remove(report_file)
+        if stop_epoch is not None:
+            options['stop_epoch'] = stop_epoch
+        return options
+
+    def run_job(self, name, options, cores, timeout, append):
+        # runs in a worker thread and only returns what the run reported, trials are updated by
+        # finish_job on the main thread, which the scheduler reads them from
+        job_start = time.time()
+        status = run_trial(to_argv(options), cores, os.path.join(self.log_path, name+'.log'), timeout, append=append)
+        losses, settings = read_report(options['report'])
+        return {'status':status, 'seconds':time.time() - job_start, 'losses':losses, 'settings':settings}
+
+    def finish_job(self, trial, options, result, cores):
+        trial['seconds'] += result['seconds']
+        trial['losses'], trial['settings'] = result['losses'], result['settings']
+        trial['epochs'] = max(trial['losses'], default=0)
+        status = result['status']
+        train_epochs = int(options.get('train_epochs', TRAIN_EPOCHS))
+        stop_epoch = options.get('stop_epoch')
+        if status == 'done' and stop_epoch is not None and stop_epoch <= trial['epochs'] < train_epochs:
+            status = 'paused'
+        trial['status'] = status
+        print('{} {} after {} epochs, {:.0f}s on cores {}'.format(trial['trial'], status, trial['epochs'], trial['seconds'], cores))
+
+    def run_trials(self, start):
+        free = core_slots(self.workers)
+        # (trial, options, cores, result) of the jobs that ended, result is None when the runner raised
+        finished = queue.Queue()
+        running = 0
+        while True:
+            timeout = None
+            if self.time_budget > 0:
+                timeout = self.time_budget - (time.time() - start)
+            while free and (timeout is None or timeout > 0):
+                job = self.next_job()
+                if job is None:
+                    break
+                trial, stop_epoch = job
+                options = self.job_options(trial, stop_epoch)
+                trial['status'] = 'running'
+                cores = free.pop(0)
+                def run(trial=trial, options=options, cores=cores, timeout=timeout, append=trial['epochs'] > 0):
+                    result = None
+                    try:
+                        result = self.run_job(trial['trial'], options, cores, timeout, append)
+                    finally:
+                        finished.put((trial, options, cores, result))
+                threading.Thread(target=run, daemon=True).start()
+                running += 1
+            if running == 0:
+                break
+            trial, options, cores, result = finished.get()
+            if result is None:
+                trial['status'] = 'failed'
+            else:
+                self.finish_job(trial, options, result, cores)
+            free.append(cores)
+            running -= 1
+
+        for trial in self.trials:
+            # never started, or paused for good by the scheduler
+            trial['status'] = {'pending':'skipped', 'paused':'stopped'}.get(trial['status'], trial['status'])
+
+    def run(self):
+        os.makedirs(self.log_path, exist_ok=True)
+        start = time.time()
+        self.prepare()
+        self.run_trials(start)
+        full = sum(int(self.trial_options(t).get('train_epochs', TRAIN_EPOCHS)) for t in self.trials)
+        print('sweep {} took {:.0f}s, {} epochs trained of {} without early termination'.format(
+            self.name, time.time() - start, sum(t['epochs'] for t in self.trials), full))
+        return self.table()
+
+    def table(self, sort='mse'):
+        # one row per trial: its status, run time, epochs, swept values, best vali loss and test metrics
+        rows = []
+        for trial in self.trials:
+            row = {'trial':trial['trial'], 'status':trial['status'], 'seconds':trial['seconds'], 'epochs':trial['epochs']}
+            row.update(trial['params'])
+            row['vali_loss'] = min(trial['losses'].values(), default=np.nan)
+            # only the folders of this run's settings, which its test has just written
+            row.update(read_metrics(trial['settings']) if trial['status'] == 'done' else {name:np.nan for name in METRICS})
+            rows.append(row)
+        return pd.DataFrame(rows).sort_values(sort, na_position='last')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    with open(args.spec) as f:
+        spec = json.load(f)
+    name = os.path.splitext(os.path.basename(args.spec))[0]
+
+    scheduler = None
+    if args.scheduler == 'asha':
+        assert 'train_epochs' not in spec['params'], 'asha needs the same train_epochs for all trials'
+        scheduler = SuccessiveHalving(int(spec.get('args', {}).get('train_epochs', TRAIN_EPOCHS)), args.min_epochs, args.eta)
+        print('asha rungs at epochs {}'.format(scheduler.rungs))
+    sweep = Sweep(spec, name, args.workers, args.time_budget, args.log_path, scheduler)
+    print('{} trials, {} at a time on cores {}'.format(len(sweep.trials), args.workers, core_slots(args.workers)))
+    table = sweep.run().sort_values(args.sort, na_position='last')
+
+    out_file = os.path.join(args.log_path, name+'.csv')
+    table.to_csv(out_file, index=False)
+    print(table.to_string(index=False))
+    print('results in {}'.format(out_file))
@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+import torch
+
+# tests import the repo modules the way main_informer.py does, from the repo root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def _prob_qk_expand(Q, K, sample_k, n_top):
+    # reference sampling of ProbAttention._prob_QK through K expanded to [B, H, L_Q, L_K, E]
+    B, H, L_K, E = K.shape
+    _, _, L_Q, _ = Q.shape
+    K_expand = K.unsqueeze(-3).expand(B, H, L_Q, L_K, E)
+    index_sample = torch.randint(L_K, (L_Q, sample_k))
+    K_sample = K_expand[:, :, torch.arange(L_Q).unsqueeze(1), index_sample, :]
+    Q_K_sample = torch.matmul(Q.unsqueeze(-2), K_sample.transpose(-2, -1)).squeeze(-2)
+    M = Q_K_sample.max(-1)[0] - torch.div(Q_K_sample.sum(-1), L_K)
+    return M.topk(n_top, sorted=False)[1]
+
+@pytest.fixture
+def prob_qk_expand():
+    return _prob_qk_expand
+
+@pytest.fixture
+def data_root():
+    # bundled solar plant csv, next to the repo
+    path = os.path.join(os.path.dirname(ROOT), 'MACS Final Project Solar energy output prediction')
+    if not os.path.exists(os.path.join(path, 'Solar Power Plant Data.csv')):
+        pytest.skip('bundled csv not found')
+    return path
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+
+from models.attn import FullAttention, BlockAttention, ProbAttention, AttentionLayer
+
+@pytest.mark.parametrize('L', [96, 300, 720])
+def test_prob_qk_top_u_matches_expand(L, prob_qk_expand):
+    # same random key sample under a fixed seed, so the same top-u queries as the expanded K
+    B, H, E, factor = 2, 4, 16, 5
+    Q = torch.randn(B, H, L, E)
+    K = torch.randn(B, H, L, E)
+    sample_k = n_top = min(factor * int(np.ceil(np.log(L))), L)
+
+    torch.manual_seed(2021)
+    ref = prob_qk_expand(Q, K, sample_k, n_top)
+    torch.manual_seed(2021)
+    out = ProbAttention(False, factor)._prob_QK(Q, K, sample_k, n_top)[1]
+    assert torch.equal(ref.sort(-1)[0], out.sort(-1)[0])
+
+@pytest.mark.parametrize('mask_flag', [False, True])
+@pytest.mark.parametrize('L', [96, 300])
+def test_block_attention_matches_full(mask_flag, L):
+    q, k, v = [torch.randn(2, L, 4, 16) for _ in range(3)]
+    full = FullAttention(mask_flag, attention_dropout=0.).eval()
+    block = BlockAttention(mask_flag, attention_dropout=0., block_size=64).eval()
+    torch.testing.assert_close(block(q, k, v, None)[0], full(q, k, v, None)[0], atol=1e-5, rtol=1e-4)
+
+class SeparateProjectionLayer(nn.Module):
+    # AttentionLayer as it was before the query/key/value projections were fused
+    def __init__(self, attention, d_model, n_heads, mix=False):
+        super(SeparateProjectionLayer, self).__init__()
+        d_keys = d_model // n_heads
+        self.inner_attention = attention
+        self.query_projection = nn.Linear(d_model, d_keys * n_heads)
+        self.key_projection = nn.Linear(d_model, d_keys * n_heads)
+        self.value_projection = nn.Linear(d_model, d_keys * n_heads)
+        self.out_projection = nn.Linear(d_keys * n_heads, d_model)
+        self.n_heads = n_heads
+        self.mix = mix
+
+    def forward(self, queries, keys, values, attn_mask):
+        B, L, _ = queries.shape
+        _, S, _ = keys.shape
+        H = self.n_heads
+        queries = self.query_projection(queries).view(B, L, H, -1)
+        keys = self.key_projection(keys).view(B, S, H, -1)
+        values = self.value_projection(values).view(B, S, H, -1)
+        out, attn = self.inner_attention(queries, keys, values, attn_mask)
+        if self.mix:
+            out = out.transpose(2,1).contiguous()
+        out = out.view(B, L, -1)
+        return self.out_projection(out), attn
+
+@pytest.mark.parametrize('mix', [False, True])
+def test_attention_layer_loads_separate_projections(mix, tmp_path):
+    d_model, n_heads = 32, 4
+    old = SeparateProjectionLayer(FullAttention(False, attention_dropout=0.), d_model, n_heads, mix=mix).eval()
+    torch.save(old.state_dict(), str(tmp_path / 'checkpoint.pth'))
+    layer = AttentionLayer(FullAttention(False, attention_dropout=0.), d_model, n_heads, mix=mix).eval()
+    layer.load_state_dict(torch.load(str(tmp_path / 'checkpoint.pth')))
+    assert 'qkv_projection.weight' in layer.state_dict()
+
+    x = torch.randn(2, 24, d_model)
+    cross = torch.randn(2, 40, d_model)
+    with torch.no_grad():
+        # self-attention projects with the stacked weight, cross attention slices it
+        cases = [(x, x, x), (x, cross, cross)]
+        refs = [old(q, k, v, None)[0] for q, k, v in cases]
+        for (q, k, v), ref in zip(cases, refs):
+            torch.testing.assert_close(layer(q, k, v, None)[0], ref)
+        layer.unfuse()
+        for (q, k, v), ref in zip(cases, refs):
+            torch.testing.assert_close(layer(q, k, v, None)[0], ref)
+    assert set(layer.state_dict()) == set(old.state_dict())
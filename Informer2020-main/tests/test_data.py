@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+import torch
+
+from data.data_loader import Dataset_Custom, DeviceWindowLoader, batch_window_loader
+from data.store import SeriesStore
+
+@pytest.fixture(autouse=True)
+def clear_stores():
+    # every dataset below preprocesses the file itself instead of sharing an earlier store
+    SeriesStore.clear()
+    yield
+    SeriesStore.clear()
+
+def solar(data_root, flag, **kwargs):
+    return Dataset_Custom(root_path=data_root, data_path='Solar Power Plant Data.csv', flag=flag,
+                          size=[96, 48, 24], features='MS', target='SystemProduction', freq='h', **kwargs)
+
+@pytest.mark.parametrize('timeenc', [0, 1])
+@pytest.mark.parametrize('chunk_size', [1000, 4096, 100000])
+def test_streamed_matches_in_memory(data_root, tmp_path, chunk_size, timeenc):
+    # 1000 and 4096 rows do not divide the 6132 train rows, 100000 reads the file in one chunk
+    for flag in ['train', 'val', 'test']:
+        ref = solar(data_root, flag, timeenc=timeenc, inverse=True)
+        SeriesStore.clear()
+        out = solar(data_root, flag, timeenc=timeenc, inverse=True,
+                    cache_path=str(tmp_path / 'cache'), chunk_size=chunk_size)
+        SeriesStore.clear()
+        np.testing.assert_allclose(out.scaler.mean, ref.scaler.mean, rtol=1e-12)
+        np.testing.assert_allclose(out.scaler.std, ref.scaler.std, rtol=1e-12)
+        np.testing.assert_array_equal(out.data_x, ref.data_x)
+        np.testing.assert_array_equal(out.data_y, ref.data_y)
+        assert out.data_stamp.dtype == ref.data_stamp.dtype
+        np.testing.assert_array_equal(out.data_stamp, ref.data_stamp)
+
+def epoch(loader, seed=0):
+    # the samplers of both loaders draw the same order from the seeded generator
+    torch.manual_seed(seed)
+    return list(loader)
+
+@pytest.mark.parametrize('inverse', [False, True])
+@pytest.mark.parametrize('shuffle, drop_last', [(True, True), (False, False)])
+def test_batch_window_loader_matches_dataloader(data_root, inverse, shuffle, drop_last):
+    data_set = solar(data_root, 'val', timeenc=1, inverse=inverse)
+    ref = epoch(torch.utils.data.DataLoader(data_set, batch_size=32, shuffle=shuffle, drop_last=drop_last))
+    out = epoch(batch_window_loader(data_set, 32, shuffle=shuffle, drop_last=drop_last))
+    assert len(out) == len(ref)
+    for ref_batch, out_batch in zip(ref, out):
+        for a, b in zip(ref_batch, out_batch):
+            assert a.dtype == b.dtype
+            assert torch.equal(a, b)
+
+def sampler(data_set, shuffle):
+    # a new sampler with its own seeded generator, the same order for every loader given one
+    if shuffle:
+        return torch.utils.data.RandomSampler(data_set, generator=torch.Generator().manual_seed(0))
+    return torch.utils.data.SequentialSampler(data_set)
+
+@pytest.mark.parametrize('timeenc', [1, 2])
+@pytest.mark.parametrize('inverse', [False, True])
+@pytest.mark.parametrize('shuffle, drop_last', [(True, True), (False, False)])
+def test_device_window_loader_matches_dataloader(data_root, timeenc, inverse, shuffle, drop_last):
+    data_set = solar(data_root, 'val', timeenc=timeenc, inverse=inverse)
+    ref = list(torch.utils.data.DataLoader(data_set, batch_size=32, sampler=sampler(data_set, shuffle),
+                                           drop_last=drop_last))
+    loader = DeviceWindowLoader(data_set, 32, shuffle=False, drop_last=drop_last, device=torch.device('cpu'),
+                                sampler=sampler(data_set, shuffle))
+    out = list(loader)
+    assert len(out) == len(ref) == len(loader)
+    for ref_batch, out_batch in zip(ref, out):
+        for a, b in zip(ref_batch, out_batch):
+            # float32 on the device, packed calendar keys stay int32
+            assert b.dtype == (torch.int32 if a.dtype == torch.int32 else torch.float32)
+            assert torch.equal(a.to(b.dtype), b)
@@ -0,0 +1,66 @@
+import threading
+
+import pytest
+import torch
+
+from models.attn import ProbAttention
+from models.model import Informer, InformerStack
+
+SEQ_LEN, LABEL_LEN, PRED_LEN = 96, 48, 24
+
+def informer(cls=Informer, e_layers=2):
+    torch.manual_seed(0)
+    return cls(7, 7, 1, SEQ_LEN, LABEL_LEN, PRED_LEN, 5, 32, 4, e_layers, 1, 64,
+               0.0, 'prob', 'timeF', 'h', 'gelu', False, True, True, torch.device('cpu')).float().eval()
+
+def batch(batch_size=4):
+    torch.manual_seed(1)
+    dec_len = LABEL_LEN + PRED_LEN
+    return (torch.randn(batch_size, SEQ_LEN, 7), torch.randn(batch_size, SEQ_LEN, 4),
+            torch.randn(batch_size, dec_len, 7), torch.randn(batch_size, dec_len, 4))
+
+def test_script_matches_eager():
+    model = informer()
+    x = batch()
+    torch.manual_seed(2021)
+    ref = model(*x)
+    scripted = torch.jit.script(model)
+    torch.manual_seed(2021)
+    torch.testing.assert_close(scripted(*x), ref)
+
+@pytest.mark.skipif(not hasattr(torch, 'compile'), reason='torch.compile not available')
+def test_compile_matches_eager():
+    from torch._inductor import config as inductor_config
+    model = informer()
+    x = batch()
+    torch.manual_seed(2021)
+    ref = model(*x)
+    # ProbAttention's torch.randint draws from the eager generator, as in the eager run
+    with inductor_config.patch(fallback_random=True):
+        compiled = torch.compile(model)
+        torch.manual_seed(2021)
+        out = compiled(*x)
+    torch.testing.assert_close(out, ref, atol=1e-5, rtol=1e-4)
+
+def test_stack_concurrent_modes_match_sequential():
+    model = informer(InformerStack, [3, 2, 1])
+    # same keys sampled in every mode, so the outputs can be compared exactly
+    for module in model.modules():
+        if isinstance(module, ProbAttention):
+            module.deterministic = True
+    x = batch()
+    model.encoder.concurrent = False
+    ref = model(*x)
+    model.encoder.concurrent = True
+    torch.testing.assert_close(model(*x), ref)
+    torch.testing.assert_close(torch.jit.script(model)(*x), ref)
+
+def test_concurrent_stack_leaves_threads_alone():
+    model = informer(InformerStack, [3, 2, 1])
+    model.encoder.concurrent = True
+    x = batch()
+    threads, alive = torch.get_num_threads(), threading.active_count()
+    model(*x)
+    # the intra-op thread count is the caller's, and the workers are gone after the call
+    assert torch.get_num_threads() == threads
+    assert threading.active_count() == alive
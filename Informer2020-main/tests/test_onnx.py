@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+import torch
+
+from data.data_loader import Dataset_Custom
+from exp.exp_informer import export_onnx
+from models.attn import ProbAttention
+from models.model import Informer
+
+pytest.importorskip('onnx')
+pytest.importorskip('onnxruntime')
+
+def test_onnxruntime_matches_torch(data_root, tmp_path):
+    from utils.onnx_runtime import OnnxPredictor
+    seq_len, label_len, pred_len = 96, 48, 24
+    data_set = Dataset_Custom(root_path=data_root, data_path='Solar Power Plant Data.csv', flag='test',
+                              size=[seq_len, label_len, pred_len], features='MS',
+                              target='SystemProduction', timeenc=1, freq='h')
+    data_loader = torch.utils.data.DataLoader(data_set, batch_size=32, shuffle=False, drop_last=True)
+
+    torch.manual_seed(0)
+    model = Informer(7, 7, 1, seq_len, label_len, pred_len, 5, 32, 4, 2, 1, 64,
+                     0.0, 'prob', 'timeF', 'h', 'gelu', False, True, True, torch.device('cpu')).float().eval()
+    # the exported graph samples keys deterministically, so does the torch reference
+    for module in model.modules():
+        if isinstance(module, ProbAttention):
+            module.deterministic = True
+
+    def inputs(batch):
+        batch_x, batch_y, batch_x_mark, batch_y_mark = [b.float() for b in batch]
+        dec_inp = torch.cat([batch_y[:, :label_len], torch.zeros_like(batch_y[:, label_len:])], dim=1)
+        return batch_x, batch_x_mark, dec_inp, batch_y_mark
+
+    path = str(tmp_path / 'informer.onnx')
+    export_onnx(model, path, inputs(next(iter(data_loader))))
+    predictor = OnnxPredictor(path)
+    with torch.no_grad():
+        for batch in data_loader:
+            x = inputs(batch)
+            np.testing.assert_allclose(predictor(*[b.numpy() for b in x]), model(*x).numpy(), atol=1e-4, rtol=1e-4)
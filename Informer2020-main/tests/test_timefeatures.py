@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+
+from models.embed import TemporalEmbedding, FusedTemporalEmbedding
+from utils.timefeatures import time_features, time_features_from_frequency_str
+
+FIELDS = {
+    'y':[],'m':['month'],'w':['month'],'d':['month','day','weekday'],
+    'b':['month','day','weekday'],'h':['month','day','weekday','hour'],
+    't':['month','day','weekday','hour','minute'],
+}
+
+def calendar_apply(dates, freq):
+    # timeenc 0 fields the way time_features read them before, one apply per row and field
+    dates = dates.copy()
+    dates['month'] = dates.date.apply(lambda row:row.month)
+    dates['day'] = dates.date.apply(lambda row:row.day)
+    dates['weekday'] = dates.date.apply(lambda row:row.weekday())
+    dates['hour'] = dates.date.apply(lambda row:row.hour)
+    dates['minute'] = dates.date.apply(lambda row:row.minute)
+    dates['minute'] = dates.minute.map(lambda x:x//15)
+    return dates[FIELDS[freq]].values
+
+def dates_frame():
+    # 37 minute steps over two years with a leap day, every quarter hour and weekday is hit
+    return pd.DataFrame({'date':pd.date_range('2016-02-20', periods=30000, freq='37min')})
+
+@pytest.mark.parametrize('freq', ['m', 'w', 'd', 'b', 'h', 't'])
+def test_calendar_fields_match_apply(freq):
+    dates = dates_frame()
+    out = time_features(dates, timeenc=0, freq=freq)
+    assert out.dtype == np.int8
+    np.testing.assert_array_equal(out, calendar_apply(dates, freq))
+    # the caller's frame is not extended
+    assert list(dates.columns) == ['date']
+
+# 'm' is not a pandas offset alias any more, with or without the vectorized path
+@pytest.mark.parametrize('freq', ['w', 'd', 'h', 't', 's'])
+def test_time_feature_classes_match(freq):
+    dates = dates_frame()
+    # the feature classes on the parsed date column, as before
+    index = pd.to_datetime(dates.date.values)
+    ref = np.vstack([feat(index) for feat in time_features_from_frequency_str(freq)]).transpose(1,0)
+    np.testing.assert_array_equal(time_features(dates, timeenc=1, freq=freq), ref)
+
+@pytest.mark.parametrize('freq', ['m', 'd', 'h', 't'])
+def test_packed_key_holds_calendar_fields(freq):
+    dates = dates_frame()
+    key = time_features(dates, timeenc=2, freq=freq)
+    assert key.dtype == np.int32 and key.shape == (len(dates), 1)
+    fields = {}
+    key = key[:, 0].astype(np.int64)
+    for name, size in [('minute',4),('hour',24),('weekday',7),('day',32),('month',13)]:
+        fields[name] = key % size
+        key = key // size
+    assert not key.any()
+    ref = calendar_apply(dates, 't')
+    for i, name in enumerate(FIELDS['t']):
+        expected = ref[:, i] if name in FIELDS[freq] else 0
+        np.testing.assert_array_equal(fields[name], expected)
+
+@pytest.mark.parametrize('freq', ['h', 't'])
+def test_fused_embedding_matches_fixed(freq):
+    d_model = 64
+    dates = dates_frame()[:96*8]
+    fields = torch.from_numpy(time_features(dates, timeenc=0, freq=freq)).reshape(8, 96, -1).float()
+    keys = torch.from_numpy(time_features(dates, timeenc=2, freq=freq)).reshape(8, 96, 1)
+    ref = TemporalEmbedding(d_model, 'fixed', freq)(fields)
+    # the tables are summed in another order than the per-field lookups
+    torch.testing.assert_close(FusedTemporalEmbedding(d_model, freq)(keys), ref, atol=1e-5, rtol=1e-5)
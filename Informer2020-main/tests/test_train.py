@@ -0,0 +1,114 @@
+import argparse
+import os
+import random
+
+import numpy as np
+import torch
+
+import exp.exp_informer as exp_informer
+from exp.exp_informer import Exp_Informer
+from models.attn import AutoAttention
+from utils.distributed import EpochDistributedSampler
+from utils.tools import EarlyStopping
+
+SETTING = 'resume_test'
+
+def train_args(data_root, checkpoints, **kwargs):
+    # main_informer.py defaults for the solar csv, with a model small enough to train on one core
+    args = dict(
+        model='informer', data='custom', root_path=data_root, data_path='Solar Power Plant Data.csv',
+        features='MS', target='SystemProduction', freq='h', detail_freq='h', cache_path='', chunk_size=0,
+        checkpoints=checkpoints, seq_len=48, label_len=24, pred_len=12, enc_in=7, dec_in=7, c_out=1,
+        d_model=16, n_heads=2, e_layers=1, d_layers=1, s_layers=[3, 2, 1], d_ff=32, factor=5, padding=0,
+        distil=True, dropout=0.05, attn='prob', embed='timeF', activation='gelu', output_attention=False,
+        mix=True, cols=None, num_workers=0, batch_windows=False, device_data=False, prefetch=0,
+        train_epochs=2, batch_size=64, log_interval=1000, patience=3, resume=False, learning_rate=1e-3,
+        lradj='type1', use_amp=False, precision='fp32', inverse=False, compile=False, quantize='none',
+        backend='torch', concurrent=False, use_gpu=False, gpu=0, use_multi_gpu=False, devices='0',
+        distributed=False)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+def seed_all(seed):
+    torch.manual_seed(seed); np.random.seed(seed); random.seed(seed)
+
+def assert_same(a, b):
+    # nested dicts/lists/tuples of tensors, arrays and plain values, compared exactly
+    assert type(a) == type(b)
+    if torch.is_tensor(a):
+        assert torch.equal(a, b)
+    elif isinstance(a, np.ndarray):
+        np.testing.assert_array_equal(a, b)
+    elif isinstance(a, dict):
+        assert a.keys() == b.keys()
+        for k in a:
+            assert_same(a[k], b[k])
+    elif isinstance(a, (list, tuple)):
+        assert len(a) == len(b)
+        for x, y in zip(a, b):
+            assert_same(x, y)
+    else:
+        assert a == b
+
+def test_resumed_training_matches_uninterrupted(data_root, tmp_path):
+    seed_all(2021)
+    Exp_Informer(train_args(data_root, str(tmp_path / 'full'))).train(SETTING)
+    full = torch.load(str(tmp_path / 'full' / SETTING / 'last.pth'), weights_only=False)
+
+    # stopped after the first epoch, as sweep.py and --stop_epoch pause a run
+    seed_all(2021)
+    Exp_Informer(train_args(data_root, str(tmp_path / 'resumed'))).train(SETTING, callback=lambda epoch, loss: epoch < 1)
+    paused = torch.load(str(tmp_path / 'resumed' / SETTING / 'last.pth'), weights_only=False)
+    assert paused['epoch'] == 0
+
+    # a new process would start from other generator states, last.pth brings them back
+    seed_all(0)
+    Exp_Informer(train_args(data_root, str(tmp_path / 'resumed'), resume=True)).train(SETTING)
+    resumed = torch.load(str(tmp_path / 'resumed' / SETTING / 'last.pth'), weights_only=False)
+
+    assert full['epoch'] == 1
+    # weights, optimizer moments and lr, EarlyStopping counters and the generator states
+    assert_same(resumed, full)
+    assert_same(torch.load(str(tmp_path / 'resumed' / SETTING / 'checkpoint.pth')),
+                torch.load(str(tmp_path / 'full' / SETTING / 'checkpoint.pth')))
+
+def test_resume_restores_sampler_epoch(data_root, tmp_path):
+    # the train sampler of a distributed run continues with the shuffle of the next epoch
+    sampler = lambda: EpochDistributedSampler(range(100), num_replicas=1, rank=0, shuffle=True)
+    uninterrupted = sampler()
+    orders = [list(uninterrupted), list(uninterrupted)]
+
+    exp = Exp_Informer(train_args(data_root, str(tmp_path)))
+    optimizer = exp._select_optimizer()
+    early_stopping = EarlyStopping()
+    state = exp._train_state(0, optimizer, early_stopping)
+    exp.train_sampler = sampler()
+    assert exp._load_train_state(state, optimizer, early_stopping) == 1
+    assert list(exp.train_sampler) == orders[1]
+
+def test_auto_attention_calibrates_fresh_models_once(data_root, tmp_path, monkeypatch):
+    calls = []
+    def calibrate_threshold(mask_flag, *args):
+        calls.append(mask_flag)
+        return 1000 if mask_flag else 24
+    monkeypatch.setattr(exp_informer, 'calibrate_threshold', calibrate_threshold)
+    monkeypatch.setattr(Exp_Informer, '_thresholds', {})
+    thresholds = lambda exp: sorted(set((m.mask_flag, m.threshold) for m in exp.model.modules()
+                                        if isinstance(m, AutoAttention)))
+    pause = lambda epoch, loss: False
+
+    # building the model does not time attention, e.g. for export or before loading a checkpoint
+    exp = Exp_Informer(train_args(data_root, str(tmp_path / 'itr0'), attn='auto'))
+    assert calls == []
+    exp.train(SETTING, callback=pause)
+    assert sorted(calls) == [False, True]
+    assert thresholds(exp) == [(False, 24), (True, 1000)]
+
+    # the next itr reuses the measurement, a resumed run keeps the thresholds of its checkpoint
+    exp = Exp_Informer(train_args(data_root, str(tmp_path / 'itr1'), attn='auto', train_epochs=1))
+    exp.train(SETTING)
+    monkeypatch.setattr(Exp_Informer, '_thresholds', {})
+    exp = Exp_Informer(train_args(data_root, str(tmp_path / 'itr0'), attn='auto', resume=True))
+    exp.train(SETTING)
+    assert sorted(calls) == [False, True]
+    assert thresholds(exp) == [(False, 24), (True, 1000)]
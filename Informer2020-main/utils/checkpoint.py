@@ -0,0 +1,104 @@
+import os
+import queue
+import threading
+
+import torch
+
+def snapshot(state, out=None):
+    '''
+    copy of a nested dict/list of tensors on the cpu, the training thread goes on updating the
+    originals. The tensors of out, an earlier snapshot of the same layout, are copied into
+    instead of allocating new ones.
+    '''
+    if torch.is_tensor(state):
+        if torch.is_tensor(out) and out.shape == state.shape and out.dtype == state.dtype:
+            return out.copy_(state.detach())
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        out = out if isinstance(out, dict) else {}
+        return {k: snapshot(v, out.get(k)) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        out = out if isinstance(out, (list, tuple)) and len(out) == len(state) else [None]*len(state)
+        return type(state)(snapshot(v, o) for v, o in zip(state, out))
+    return state
+
+def atomic_save(state, path):
+    # written to a temporary file and renamed, a crash mid-write leaves the previous file intact
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class CheckpointManager():
+    '''
+    saves checkpoints into path from a background thread. save() takes a snapshot of the state
+    on the calling thread and returns, the file is written later with atomic_save; wait() blocks
+    until everything queued is on disk and raises the error of a failed write. The snapshot
+    buffers of each name are reused by its next save.
+    '''
+    def __init__(self, path, enabled=True):
+        self.path = path
+        # disabled on the ranks other than 0 of a distributed run, save() does nothing there
+        self.enabled = enabled
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = None
+        self.buffers = {}
+        # per name, set once its last queued write is done
+        self.written = {}
+
+    def _write(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                state, path, written = item
+                try:
+                    if self.error is None:
+                        atomic_save(state, path)
+                finally:
+                    written.set()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def save(self, state, name):
+        if not self.enabled:
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._write, daemon=True)
+            self.thread.start()
+        if name in self.written:
+            # the buffers of name are free again once its earlier write is done,
+            # writes of other names do not hold it up
+            self.written[name].wait()
+        self.buffers[name] = snapshot(state, self.buffers.get(name))
+        self.written[name] = threading.Event()
+        self.queue.put((self.buffers[name], os.path.join(self.path, name), self.written[name]))
+
+    def load(self, name, map_location=None):
+        # None when there is no such checkpoint
+        file = os.path.join(self.path, name)
+        if not os.path.exists(file):
+            return None
+        return torch.load(file, map_location=map_location, weights_only=False)
+
+    def wait(self):
+        if self.thread is not None:
+            self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.buffers = {}
+        self.written = {}
+        self.wait()
@@ -0,0 +1,88 @@
+import os
+import socket
+import sys
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.utils.data import Sampler, DistributedSampler
+
+# multi-process CPU training with torch.distributed (gloo), on one host or started by torchrun
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process():
+    return get_rank() == 0
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+def all_reduce_sum(values):
+    # elementwise sum of a list of floats over all ranks
+    if not is_distributed():
+        return list(values)
+    t = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(t)
+    return t.tolist()
+
+def init_distributed():
+    # rank and world size from the environment set by launch() or torchrun
+    dist.init_process_group('gloo')
+    # the ranks of a host share its cores instead of each taking all of them
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', dist.get_world_size()))
+    torch.set_num_threads(max(1, torch.get_num_threads() // local_world_size))
+    # progress is printed once by rank 0, errors still reach stderr from every rank
+    if not is_main_process():
+        sys.stdout = open(os.devnull, 'w')
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _worker(rank, fn, nproc, port, args):
+    os.environ.update({'MASTER_ADDR':'127.0.0.1', 'MASTER_PORT':str(port), 'RANK':str(rank),
+                       'LOCAL_RANK':str(rank), 'WORLD_SIZE':str(nproc), 'LOCAL_WORLD_SIZE':str(nproc)})
+    fn(*args)
+
+def launch(fn, nproc, *args):
+    # fn(*args) in nproc local processes, each sets up its process group with init_distributed()
+    mp.spawn(_worker, args=(fn, nproc, _free_port(), args), nprocs=nproc, join=True)
+
+class ShardSampler(Sampler):
+    '''
+    contiguous 1/num_replicas of the indices for one rank, in order. Unlike DistributedSampler
+    nothing is padded, so every window of val/test counts once in the all-reduced loss.
+    '''
+    def __init__(self, data_source, num_replicas=None, rank=None):
+        self.num_samples = len(data_source)
+        self.num_replicas = get_world_size() if num_replicas is None else num_replicas
+        self.rank = get_rank() if rank is None else rank
+        self.start = self.num_samples * self.rank // self.num_replicas
+        self.end = self.num_samples * (self.rank+1) // self.num_replicas
+
+    def __iter__(self):
+        return iter(range(self.start, self.end))
+
+    def __len__(self):
+        return self.end - self.start
+
+class EpochDistributedSampler(DistributedSampler):
+    # DistributedSampler that moves on to the next epoch's shuffle after every pass by itself,
+    # all ranks make the same number of passes so their permutations stay the same
+    def __iter__(self):
+        indices = super(EpochDistributedSampler, self).__iter__()
+        self.epoch += 1
+        return indices
@@ -1,10 +1,54 @@
 import torch
+from functools import lru_cache
+
+@lru_cache(maxsize=64)
+def _position_arange(L, device):
+    # cached masks are reused across no_grad/inference_mode and training steps,
+    # so they are always created as normal tensors
+    with torch.inference_mode(False), torch.no_grad():
+        return torch.arange(L, device=device)
+
+@lru_cache(maxsize=64)
+def _causal_mask(L, S, device):
+    with torch.inference_mode(False), torch.no_grad():
+        return torch.triu(torch.ones(L, S, dtype=torch.bool, device=device), diagonal=1)
+
+def is_compiling():
+    # torch.compiler.is_compiling(), False on a torch without torch.compiler
+    compiler = getattr(torch, 'compiler', None)
+    return compiler is not None and compiler.is_compiling()
+
+# the caches live in python, scripted/traced/compiled graphs build their tensors inline
+@torch.jit.unused
+def _cached_arange(L: int, device: torch.device):
+    if is_compiling():
+        return torch.arange(L, device=device)
+    return _position_arange(L, device)
+
+@torch.jit.unused
+def _cached_causal_mask(L: int, S: int, device: torch.device):
+    if is_compiling():
+        return torch.triu(torch.ones(L, S, dtype=torch.bool, device=device), diagonal=1)
+    return _causal_mask(L, S, device)
+
+def position_arange(L: int, device: torch.device):
+    if torch.jit.is_scripting() or torch.jit.is_tracing():
+        return torch.arange(L, device=device)
+    return _cached_arange(L, device)
+
+def causal_mask(L: int, S: int, device: torch.device):
+    # [1, 1, L, S] view of a cached mask, broadcasts against [B, H, L, S] scores
+    if torch.jit.is_scripting() or torch.jit.is_tracing():
+        return torch.triu(torch.ones(L, S, dtype=torch.bool, device=device), diagonal=1)[None, None]
+    return _cached_causal_mask(L, S, device)[None, None]
+
+def prob_mask(index, S: int, device: torch.device):
+    # row index[b, h, u] of the causal mask: positions after the selected query are masked
+    return position_arange(S, device) > index.to(device).unsqueeze(-1)
 
 class TriangularCausalMask():
     def __init__(self, B, L, device="cpu"):
-        mask_shape = [B, 1, L, L]
-        with torch.no_grad():
-            self._mask = torch.triu(torch.ones(mask_shape, dtype=torch.bool), diagonal=1).to(device)
+        self._mask = causal_mask(L, L, device=torch.device(device))
 
     @property
     def mask(self):
@@ -12,13 +56,8 @@ class TriangularCausalMask():
 
 class ProbMask():
     def __init__(self, B, H, L, index, scores, device="cpu"):
-        _mask = torch.ones(L, scores.shape[-1], dtype=torch.bool).to(device).triu(1)
-        _mask_ex = _mask[None, None, :].expand(B, H, L, scores.shape[-1])
-        indicator = _mask_ex[torch.arange(B)[:, None, None],
-                             torch.arange(H)[None, :, None],
-                             index, :].to(device)
-        self._mask = indicator.view(scores.shape).to(device)
-    
+        self._mask = prob_mask(index, scores.shape[-1], torch.device(device))
+
     @property
     def mask(self):
-        return self._mask
\ No newline at end of file
+        return self._mask
@@ -0,0 +1,20 @@
+import numpy as np
+import onnxruntime as ort
+
+# serving side of the onnx backend, needs numpy and onnxruntime only
+
+class OnnxPredictor():
+    input_names = ['x_enc', 'x_mark_enc', 'x_dec', 'x_mark_dec']
+
+    def __init__(self, path, num_threads=0):
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads
+        # the session is created once and reused for every batch
+        self.session = ort.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, x_enc, x_mark_enc, x_dec, x_mark_dec):
+        # integer time marks are packed calendar keys, fed as int32
+        feeds = {name: np.ascontiguousarray(x, dtype=np.int32 if np.issubdtype(x.dtype, np.integer) else np.float32)
+                 for name, x in zip(self.input_names, [x_enc, x_mark_enc, x_dec, x_mark_dec])}
+        return self.session.run(None, feeds)[0]
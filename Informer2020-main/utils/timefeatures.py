@@ -53,7 +53,7 @@ class MonthOfYear(TimeFeature):
 class WeekOfYear(TimeFeature):
     """Week of year encoded as value between [-0.5, 0.5]"""
     def __call__(self, index: pd.DatetimeIndex) -> np.ndarray:
-        return (index.week - 1) / 52.0 - 0.5
+        return (index.isocalendar().week.values - 1) / 52.0 - 0.5
 
 def time_features_from_frequency_str(freq_str: str) -> List[TimeFeature]:
     """
@@ -89,6 +89,9 @@ def time_features_from_frequency_str(freq_str: str) -> List[TimeFeature]:
         ],
     }
 
+    # newer pandas dropped the T alias of minutely
+    if freq_str[-1:] in ['t', 'T']:
+        freq_str = freq_str[:-1] + 'min'
     offset = to_offset(freq_str)
 
     for offset_type, feature_classes in features_by_offsets.items():
@@ -132,20 +135,31 @@ def time_features(dates, timeenc=1, freq='h'):
     > * S - [Second of minute, minute of hour, hour of day, day of week, day of month, day of year]
 
     *minute returns a number from 0-3 corresponding to the 15 minute period it falls into.
+
+    If `timeenc` is 2, the `timeenc` 0 fields are packed into one int32 key
+    (((month*32 + day)*7 + weekday)*24 + hour)*4 + minute, fields not in `freq` are 0.
     """
-    if timeenc==0:
-        dates['month'] = dates.date.apply(lambda row:row.month,1)
-        dates['day'] = dates.date.apply(lambda row:row.day,1)
-        dates['weekday'] = dates.date.apply(lambda row:row.weekday(),1)
-        dates['hour'] = dates.date.apply(lambda row:row.hour,1)
-        dates['minute'] = dates.date.apply(lambda row:row.minute,1)
-        dates['minute'] = dates.minute.map(lambda x:x//15)
+    # one DatetimeIndex for all features, the caller's frame is left as it is
+    index = pd.DatetimeIndex(dates.date)
+    if timeenc==0 or timeenc==2:
+        calendar = {
+            'month':index.month, 'day':index.day, 'weekday':index.dayofweek,
+            'hour':index.hour, 'minute':index.minute // 15,
+        }
         freq_map = {
             'y':[],'m':['month'],'w':['month'],'d':['month','day','weekday'],
             'b':['month','day','weekday'],'h':['month','day','weekday','hour'],
             't':['month','day','weekday','hour','minute'],
         }
-        return dates[freq_map[freq.lower()]].values
+        if timeenc==2:
+            key = np.zeros(len(index), dtype=np.int32)
+            for name, size in [('month',13),('day',32),('weekday',7),('hour',24),('minute',4)]:
+                key = key*size + (np.asarray(calendar[name]) if name in freq_map[freq.lower()] else 0)
+            return key[:, None]
+        # every calendar field fits in int8
+        stamp = np.empty((len(index), len(freq_map[freq.lower()])), dtype=np.int8)
+        for i, name in enumerate(freq_map[freq.lower()]):
+            stamp[:, i] = calendar[name]
+        return stamp
     if timeenc==1:
-        dates = pd.to_datetime(dates.date.values)
-        return np.vstack([feat(dates) for feat in time_features_from_frequency_str(freq)]).transpose(1,0)
+        return np.vstack([feat(index) for feat in time_features_from_frequency_str(freq)]).transpose(1,0)
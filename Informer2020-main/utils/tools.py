@@ -17,14 +17,16 @@ def adjust_learning_rate(optimizer, epoch, args):
         print('Updating learning rate to {}'.format(lr))
 
 class EarlyStopping:
-    def __init__(self, patience=7, verbose=False, delta=0):
+    def __init__(self, patience=7, verbose=False, delta=0, checkpoints=None):
         self.patience = patience
         self.verbose = verbose
         self.counter = 0
         self.best_score = None
         self.early_stop = False
-        self.val_loss_min = np.Inf
+        self.val_loss_min = np.inf
         self.delta = delta
+        # CheckpointManager writing the best weights in the background, torch.save when None
+        self.checkpoints = checkpoints
 
     def __call__(self, val_loss, model, path):
         score = -val_loss
@@ -44,9 +46,20 @@ class EarlyStopping:
     def save_checkpoint(self, val_loss, model, path):
         if self.verbose:
             print(f'Validation loss decreased ({self.val_loss_min:.6f} --> {val_loss:.6f}).  Saving model ...')
-        torch.save(model.state_dict(), path+'/'+'checkpoint.pth')
+        if self.checkpoints is not None:
+            self.checkpoints.save(model.state_dict(), 'checkpoint.pth')
+        else:
+            torch.save(model.state_dict(), path+'/'+'checkpoint.pth')
         self.val_loss_min = val_loss
 
+    def state_dict(self):
+        return {'counter':self.counter, 'best_score':self.best_score,
+                'early_stop':self.early_stop, 'val_loss_min':self.val_loss_min}
+
+    def load_state_dict(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
 class dotdict(dict):
     """dot.notation access to dictionary attributes"""
     __getattr__ = dict.get
@@ -57,10 +70,31 @@ class StandardScaler():
     def __init__(self):
         self.mean = 0.
         self.std = 1.
+        self.count = 0
     
     def fit(self, data):
         self.mean = data.mean(0)
         self.std = data.std(0)
+        self.count = len(data)
+
+    def partial_fit(self, data):
+        # one chunk of rows at a time, merged with Chan's parallel update of count, mean and
+        # sum of squared deviations; after the last chunk mean and std match fit() on all rows
+        if len(data) == 0:
+            return
+        data = np.asarray(data, dtype=np.float64)
+        mean = data.mean(0)
+        m2 = ((data - mean)**2).sum(0)
+        if self.count == 0:
+            self.m2 = m2
+        else:
+            total = self.count + len(data)
+            delta = mean - self.mean
+            mean = self.mean + delta * len(data) / total
+            self.m2 = self.m2 + m2 + delta**2 * self.count * len(data) / total
+        self.mean = mean
+        self.count += len(data)
+        self.std = np.sqrt(self.m2 / self.count)
 
     def transform(self, data):
         mean = torch.from_numpy(self.mean).type_as(data).to(data.device) if torch.is_tensor(data) else self.mean